@@ -0,0 +1,225 @@
+"""
+Pickups per zone and time bucket (Notebooks/taxiPickups.csv for any zones and bucket size),
+kept up to date as new monthly files arrive.
+
+    python aggregate.py "TLC Data" --store pickups --freq 1h
+    python aggregate.py "TLC Data" --store pickups --export taxiPickups.csv
+
+Every yellow*.csv file is streamed in chunks through the usual preprocessing;
+pickups are assigned to zones (zones.py) and counted per (bucket, zone). The
+counts of each file are saved in the store (store/counts/<file>.parquet) and
+store/manifest.json records the files counted, the bucket size and the
+zones. Later runs only read the files that are new or changed since, so the
+history is never scanned again.
+
+PickupCounts holds the cumulative sums of the counts per (bucket x zone):
+totals over any window are two lookups, rolling sums one subtraction.
+"""
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from import_dataset import data_files, file_fingerprint, iter_data, read_cache, write_cache
+from train import DTYPE, PARSE_DATES, USECOLS
+from zones import ZONES_PATH, load_zones
+
+
+def count_pickups(df, index, freq='1h'):
+    """
+    Trips of df per pickup time bucket (fixed size freq) and pickup zone, as
+    PickupTime, Location (zone code into index.names), TripCount.
+    Trips outside every zone are not counted.
+    """
+    step = pd.Timedelta(freq).value
+    zone = index.assign(df['pickup_latitude'], df['pickup_longitude'])
+    keep = zone >= 0
+    bucket = df['tpep_pickup_datetime'].to_numpy(dtype='datetime64[ns]')[keep].astype('int64') // step
+    # One integer key per (bucket, zone) pair, counted with a single sort
+    keys, counts = np.unique(bucket * len(index.names) + zone[keep], return_counts=True)
+    bucket, zone = np.divmod(keys, len(index.names))
+    return pd.DataFrame({'PickupTime': pd.to_datetime(bucket * step),
+                         'Location': zone.astype('int32'), 'TripCount': counts})
+
+
+def merge_counts(parts):
+    # Sum counts of the same (bucket, zone) from several chunks or files
+    if not parts:
+        return pd.DataFrame({'PickupTime': pd.to_datetime([]),
+                             'Location': np.array([], dtype='int32'),
+                             'TripCount': np.array([], dtype='int64')})
+    df = pd.concat(parts, ignore_index=True)
+    return df.groupby(['PickupTime', 'Location'], as_index=False, sort=True)['TripCount'].sum()
+
+
+def zone_spec(index):
+    return [[name, *map(float, box)] for name, *box in
+            zip(index.names, index.lat1, index.lat2, index.lon1, index.lon2)]
+
+
+def read_manifest(store, index, freq):
+    """
+    The store's manifest. A store built with other zones or another bucket
+    size cannot be updated: its counts would not add up with the new ones.
+    """
+    path = store / 'manifest.json'
+    if not path.exists():
+        return {'freq': freq, 'zones': zone_spec(index), 'files': {}}
+    with open(path) as f:
+        manifest = json.load(f)
+    if (pd.Timedelta(manifest['freq']) != pd.Timedelta(freq)
+            or manifest['zones'] != zone_spec(index)):
+        raise ValueError(f"{store} was built with other zones or buckets "
+                         f"({manifest['freq']}), use a new store")
+    return manifest
+
+
+def write_manifest(manifest, store):
+    tmp = store / 'manifest.json.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, store / 'manifest.json')
+
+
+def update(data_dir, store, index=None, freq='1h', file_substr='yellow', **stream_kwargs):
+    """
+    Count the pickups of the files in data_dir that the store has not counted
+    yet (or that changed since). Returns the names of the files counted.
+    """
+    index = index or load_zones()
+    (store / 'counts').mkdir(parents=True, exist_ok=True)
+    manifest = read_manifest(store, index, freq)
+    files = [f for f in data_files(data_dir, file_substr)
+             if manifest['files'].get(f.name) != file_fingerprint(f)]
+    for f in files:
+        start = time.perf_counter()
+        parts = [count_pickups(chunk, index, freq)
+                 for chunk in iter_data(path_dir=data_dir, filename=f.name,
+                                        parse_dates=PARSE_DATES, usecols=USECOLS, dtype=DTYPE,
+                                        skiprows=1, **stream_kwargs)]
+        counts = merge_counts(parts)
+        write_cache(counts, store / 'counts' / f'{f.stem}.parquet')
+        # Recorded file by file, so an interrupted run resumes where it stopped
+        manifest['files'][f.name] = file_fingerprint(f)
+        write_manifest(manifest, store)
+        print(f"Counted {counts['TripCount'].sum()} pickups of {f.name} "
+              f"in {time.perf_counter() - start:.1f}s\n")
+    return [f.name for f in files]
+
+
+class PickupCounts:
+    """
+    Pickups of a store per bucket, from the first to the last one (buckets
+    without pickups count 0), and zone. Only the cumulative sums are kept,
+    cumsum[i] being the pickups before bucket i: one (buckets + 1) x zones
+    array, int32 unless the counts need more. That is still 4 bytes per
+    bucket and zone (about 500 MB for 12 years of 15min buckets and 300
+    zones), so load a bounded range where memory is short.
+    """
+
+    def __init__(self, counts, zones, freq='1h'):
+        self.freq = pd.Timedelta(freq)
+        self.zones = list(zones)
+        start, rows = pd.Timestamp(0), 0
+        if len(counts):
+            start = counts['PickupTime'].min()
+            row = ((counts['PickupTime'] - start) // self.freq).to_numpy()
+            rows = row.max() + 1
+        dtype = np.int32 if counts['TripCount'].sum() < 2**31 else np.int64
+        # Counts go one row down, then are summed in place: no second array
+        self.cumsum = np.zeros((rows + 1, len(self.zones)), dtype=dtype)
+        if len(counts):
+            np.add.at(self.cumsum, (row + 1, counts['Location'].to_numpy()),
+                      counts['TripCount'].to_numpy().astype(dtype))
+            np.cumsum(self.cumsum, axis=0, out=self.cumsum)
+        self.times = pd.date_range(start, periods=rows, freq=self.freq)
+
+    @classmethod
+    def load(cls, store, start=None, end=None):
+        """
+        Counts of the store, only of the buckets in [start, end) when given.
+        """
+        with open(store / 'manifest.json') as f:
+            manifest = json.load(f)
+        parts = []
+        for path in sorted((store / 'counts').glob('*.parquet')):
+            part = read_cache(path)
+            if start is not None:
+                part = part[part['PickupTime'] >= pd.Timestamp(start)]
+            if end is not None:
+                part = part[part['PickupTime'] < pd.Timestamp(end)]
+            parts.append(part)
+        return cls(merge_counts(parts), [name for name, *_ in manifest['zones']],
+                   manifest['freq'])
+
+    def position(self, time):
+        # Number of buckets starting before time
+        return int(np.clip(np.ceil((pd.Timestamp(time) - self.times[0]) / self.freq)
+                           if len(self.times) else 0, 0, len(self.times)))
+
+    def total(self, start, end):
+        """
+        Pickups per zone in the buckets starting in [start, end), as a Series.
+        """
+        i, j = self.position(start), self.position(end)
+        return pd.Series(self.cumsum[max(i, j)] - self.cumsum[i], index=self.zones,
+                         name='TripCount')
+
+    def last(self, window, end=None):
+        # Pickups per zone over the window (e.g. '3h') ending at end (default: the last bucket)
+        if end is None:
+            end = self.times[-1] + self.freq if len(self.times) else pd.Timestamp(0)
+        end = pd.Timestamp(end)
+        return self.total(end - pd.Timedelta(window), end)
+
+    def rolling(self, window, start=None, end=None):
+        """
+        Pickups per zone over the window ending with each bucket in
+        [start, end), one row per bucket (DataFrame.rolling(window).sum()
+        on the counts, with partial windows at the start).
+        """
+        n = max(1, int(pd.Timedelta(window) // self.freq))
+        i = self.position(start) if start is not None else 0
+        j = self.position(end) if end is not None else len(self.times)
+        rows = np.arange(i, max(i, j)) + 1
+        sums = self.cumsum[rows] - self.cumsum[np.maximum(rows - n, 0)]
+        return pd.DataFrame(sums, index=self.times[rows - 1], columns=self.zones)
+
+    def to_frame(self):
+        # Long format of Notebooks/taxiPickups.csv: PickupTime, Location, TripCount
+        return pd.DataFrame({'PickupTime': np.repeat(self.times, len(self.zones)),
+                             'Location': np.tile(self.zones, len(self.times)),
+                             'TripCount': np.diff(self.cumsum, axis=0).ravel()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count pickups per zone and time bucket.')
+    parser.add_argument('data_dir', type=Path, help='folder with the yellow*.csv files')
+    parser.add_argument('--store', type=Path, default=Path('pickups'))
+    parser.add_argument('--freq', default='1h', help='bucket size, e.g. 15min, 1h, 1d')
+    parser.add_argument('--zones', default=ZONES_PATH, help='zones csv (Names, Lat1, Lat2, Lon1, Lon2)')
+    parser.add_argument('--chunksize', type=int, default=1_000_000)
+    parser.add_argument('--max-memory', type=float, help='MB per chunk, overrides --chunksize')
+    parser.add_argument('--compact', action='store_true', help='read with compact dtypes')
+    parser.add_argument('--export', help='write all counts to this csv')
+    args = parser.parse_args()
+
+    files = update(args.data_dir, args.store, load_zones(args.zones), args.freq,
+                   chunksize=args.chunksize, compact=args.compact,
+                   max_memory=args.max_memory and args.max_memory * 2**20)
+    print(f"{len(files)} new files counted\n")
+    counts = PickupCounts.load(args.store)
+    if len(counts.times):
+        print(f"{counts.times[0]} to {counts.times[-1]}, totals:")
+        print(counts.total(counts.times[0], counts.times[-1] + counts.freq).to_string())
+    if args.export:
+        counts.to_frame().to_csv(args.export, index=False)
+        print(f"Wrote {args.export}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+Client for the AI Platform prediction endpoint.
+
+The discovery based service object is built once per process, and the
+authorized keep-alive HTTP connections are pooled per process: a call
+checks one out and returns it when done. Streamlit runs every rerun on a
+new thread, so connections kept per thread would never be reused.
+Repeated predictions only pay for the predict round trip.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+
+import google.auth
+import google_auth_httplib2
+import httplib2
+import pandas as pd
+from google.api_core.client_options import ClientOptions
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient import discovery
+
+from helper import cols, dtype
+from metrics import timer
+
+
+ENDPOINT = os.environ.get('ML_ENDPOINT', 'https://ml.googleapis.com')
+TIMEOUT = float(os.environ.get('ML_TIMEOUT', 30))
+# How long AsyncPredictor waits for the endpoint before answering locally
+DEADLINE = float(os.environ.get('ML_DEADLINE', 3))
+RETRIES = int(os.environ.get('ML_RETRIES', 3))
+SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+
+# Idle connections per (endpoint, timeout)
+pool = {}
+pool_lock = threading.Lock()
+
+
+def model_name(project, model, version):
+    return f'projects/{project}/models/{model}/versions/{version}'
+
+
+@lru_cache(maxsize=None)
+def get_service(endpoint=ENDPOINT):
+    # Uses the discovery document bundled with google-api-python-client,
+    # so no network call is made here. Requests are sent with get_http().
+    client_options = ClientOptions(api_endpoint=endpoint)
+    return discovery.build('ml', 'v1', client_options=client_options,
+                           http=httplib2.Http(), static_discovery=True)
+
+
+@lru_cache(maxsize=None)
+def get_credentials(endpoint=ENDPOINT):
+    # Plain http endpoints are local stand-ins for ml.googleapis.com
+    if endpoint.startswith('http://'):
+        return AnonymousCredentials()
+    credentials, _ = google.auth.default(scopes=SCOPES)
+    return credentials
+
+
+@contextmanager
+def get_http(endpoint=ENDPOINT, timeout=TIMEOUT):
+    """
+    with get_http() as http: ...
+    httplib2 connections are not thread safe, so a connection is only used by
+    one call at a time: an idle one is checked out of the pool (or a new one
+    made) and put back afterwards.
+    """
+    key = (endpoint, timeout)
+    with pool_lock:
+        idle = pool.setdefault(key, [])
+        http = idle.pop() if idle else None
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(get_credentials(endpoint),
+                                                   http=httplib2.Http(timeout=timeout))
+    try:
+        yield http
+    finally:
+        with pool_lock:
+            pool[key].append(http)
+
+
+def predict(instances, name, endpoint=ENDPOINT, timeout=TIMEOUT, retries=RETRIES):
+    """
+    Send instances (a list of feature rows) to the model version `name`.
+    Failed calls (connection errors, 429 and 5xx responses) are retried
+    `retries` times with exponential backoff.
+    Returns the response and a dict with the seconds spent getting the
+    client ready ('setup') and waiting for the endpoint ('predict').
+    """
+    start = time.perf_counter()
+    service = get_service(endpoint)
+    with get_http(endpoint, timeout) as http:
+        ready = time.perf_counter()
+        with timer('remote'):
+            response = service.projects().predict(name=name,
+                                                  body={'instances': instances}
+                                                  ).execute(http=http, num_retries=retries)
+    done = time.perf_counter()
+    return response, {'setup': ready - start, 'predict': done - ready}
+
+
+class RequestCoalescer:
+    """
+    Merge prediction requests from concurrent sessions into batched calls.
+
+    Callers submit their prepared rows and get a Future. A background thread
+    flushes the queued rows as one request when max_batch rows are waiting or
+    max_wait seconds after the first row arrived, then hands each caller
+    a response holding only its own predictions (or the error).
+    """
+
+    def __init__(self, name, max_batch=64, max_wait=0.005, max_concurrent=4,
+                 endpoint=ENDPOINT, timeout=TIMEOUT, retries=RETRIES):
+        self.name = name
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.retries = retries
+        self.calls = 0
+        self.rows = 0
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.senders = ThreadPoolExecutor(max_workers=max_concurrent)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, instances):
+        future = Future()
+        self.requests.put((list(instances), future))
+        return future
+
+    def predict(self, instances, timeout=None):
+        # Blocking call with the same return value as predict()
+        return self.submit(instances).result(timeout)
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            self.senders.submit(self.send, batch)
+
+    def send(self, batch):
+        instances = [row for rows, _ in batch for row in rows]
+        with self.lock:
+            self.calls += 1
+            self.rows += len(instances)
+        try:
+            response, latency = predict(instances, self.name, endpoint=self.endpoint,
+                                        timeout=self.timeout, retries=self.retries)
+        except Exception as exc:
+            for _, future in batch:
+                future.set_exception(exc)
+            return
+        start = 0
+        for rows, future in batch:
+            if 'error' in response:
+                result = {'error': response['error']}
+            else:
+                result = {'predictions': response['predictions'][start:start + len(rows)]}
+            start += len(rows)
+            future.set_result((result, {**latency, 'batch_size': len(instances)}))
+
+
+class AsyncPredictor:
+    """
+    Issue many prediction calls concurrently from asyncio.
+
+    At most max_concurrent calls are in flight, and each one must finish
+    within `deadline` seconds ($ML_DEADLINE, much shorter than the socket
+    timeout, so that a slow endpoint does not hold the caller). A call that
+    times out is answered by the fallback model when one is given (already
+    loaded, e.g. by model_store.load_model(), so that a timeout does not also
+    pay for a model load), otherwise asyncio.TimeoutError is raised.
+    send(instances) performs one blocking call and returns (response, latency);
+    it defaults to predict() for the model version `name`, and can be
+    e.g. RequestCoalescer.predict.
+    """
+
+    def __init__(self, name=None, send=None, max_concurrent=8, deadline=DEADLINE,
+                 fallback=None, endpoint=ENDPOINT, timeout=TIMEOUT, retries=RETRIES):
+        self.send = send or partial(predict, name=name, endpoint=endpoint,
+                                    timeout=timeout, retries=retries)
+        self.max_concurrent = max_concurrent
+        self.deadline = deadline
+        self.fallback = fallback
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent)
+        # Timed out calls keep their sender thread busy, so the fallbacks get their own
+        self.local_executor = ThreadPoolExecutor(max_workers=max_concurrent)
+        # asyncio semaphores belong to one event loop, and predict_sync starts a new one per call
+        self.semaphores = weakref.WeakKeyDictionary()
+
+    def semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.semaphores:
+            self.semaphores[loop] = asyncio.Semaphore(self.max_concurrent)
+        return self.semaphores[loop]
+
+    async def predict(self, instances):
+        loop = asyncio.get_running_loop()
+        async with self.semaphore():
+            start = time.perf_counter()
+            call = loop.run_in_executor(self.executor, self.send, instances)
+            try:
+                return await asyncio.wait_for(call, self.deadline)
+            except asyncio.TimeoutError:
+                if self.fallback is None:
+                    raise
+                response = await loop.run_in_executor(self.local_executor,
+                                                      self.predict_locally, instances)
+                return response, {'predict': time.perf_counter() - start,
+                                  'source': 'local'}
+
+    async def predict_many(self, batches):
+        return await asyncio.gather(*(self.predict(instances) for instances in batches))
+
+    def predict_sync(self, instances):
+        # Blocking wrapper for callers without an event loop (e.g. main.py)
+        return asyncio.run(self.predict(instances))
+
+    def predict_all(self, batches):
+        # Blocking wrapper around predict_many
+        return asyncio.run(self.predict_many(batches))
+
+    def predict_locally(self, instances):
+        data = pd.DataFrame(instances, columns=cols).astype(dtype)
+        with timer('predict'):
+            return {'predictions': self.fallback.predict(data).tolist()}
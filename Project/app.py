@@ -1,8 +1,9 @@
 import streamlit as st
-import pandas as pd
 import folium
-import joblib
-from helper import calculate_distance, prepare_data
+from helper import cached_distance, cached_features, trip_points
+from metrics import Timings, serve_metrics, timer
+from model_store import load_model as load_artifact
+from prediction_cache import feature_key, make_cache, model_version
 # from folium.plugins import HeatMap
 from streamlit_folium import folium_static
 # import time
@@ -13,18 +14,38 @@ from datetime import datetime
 # Load model
 @st.cache(allow_output_mutation=True)
 def load_model():
-    my_model = joblib.load('model.joblib')
-    return my_model
+    # model.forest or model.mmap.joblib (see model_store.py) when present,
+    # model.joblib otherwise. Loaded by the first session, not at startup:
+    # only the gunicorn service (serve.py) preloads the model.
+    my_model, load_info = load_artifact()
+    return my_model, load_info['path']
 
 
-model = load_model()
+@st.cache(allow_output_mutation=True)
+def load_cache():
+    return make_cache(model_version(load_model()[1]))
+
+
+@st.cache(allow_output_mutation=True)
+def start_metrics():
+    # Prometheus metrics on $METRICS_PORT, if set
+    return serve_metrics()
+
+
+timings = Timings()
+model, _ = load_model()
+start_metrics()
+# time_input resets whenever its default changes, so the default pickup time
+# is fixed once per session instead of taking datetime.now() on every rerun
+if 'pickup_time' not in st.session_state:
+    st.session_state.pickup_time = datetime.now().time().replace(second=0, microsecond=0)
 
 # st.title("""New York City Map""")
 st.markdown("<h1 style='text-align: center; color: black;'>New York City Map</h1>", unsafe_allow_html=True)
 
 st.sidebar.header('Taxi Trip Details')
 dt = st.sidebar.date_input('Date')
-tmd = st.sidebar.time_input('Time Of Day', value=datetime.now().time())
+tmd = st.sidebar.time_input('Time Of Day', value=st.session_state.pickup_time)
 
 # st.sidebar.subheader('Pickup Coordinates')
 st.sidebar.write("""#### Pickup Coordinates""")
@@ -43,7 +64,9 @@ drop_long = st.sidebar.number_input('Longitude', min_value=-74.1923,
                                     max_value=-73.5982, format='%.4f')
 
 
-dist1, dist2, dist3 = calculate_distance((pick_lat, pick_long), (drop_lat, drop_long))
+pickup, dropoff = (pick_lat, pick_long), (drop_lat, drop_long)
+with timings.section('distance'):
+    dist1 = cached_distance(pickup, dropoff)
 # st.sidebar.write("""#### Distance (miles)""")
 # st.sidebar.write(f"{dist1} miles")
 # st.sidebar.write(f"{dist2} miles")
@@ -60,20 +83,25 @@ col1, col2 = st.sidebar.beta_columns(2)
 with col1:
     duration = st.button('Predict')
 
-prepared_data = prepare_data((pick_lat, pick_long), (drop_lat, drop_long),
-                             dist1, dt, tmd, passenger, )
+with timings.section('features'), timer('prepare'):
+    prepared_data = cached_features(pickup, dropoff, dist1, dt, tmd, passenger)
+    key = feature_key(prepared_data.iloc[0])
 with col2:
     if duration:
-        dur = model.predict(prepared_data)[-1]
-        st.write(f"{dur:.2f} +/- 4.00 minutes")
+        with timings.section('predict'), timer('predict'):
+            dur = load_cache().predict(prepared_data, model.predict)[-1]
+        st.session_state.prediction = {'key': key, 'minutes': float(dur)}
+    # The last prediction stays on the page until the next one
+    prediction = st.session_state.get('prediction')
+    if prediction:
+        st.write(f"{prediction['minutes']:.2f} +/- 4.00 minutes")
+        if prediction['key'] != key:
+            st.caption("for the previous trip details, press Predict to update")
 
 # Plot Map
-data = pd.DataFrame({'latitude': [pick_lat, drop_lat, ],
-                     'longitude': [pick_long, drop_long, ]
-                     },
-                    index=['Pickup', 'Dropoff'],)
-
-st.map(data=data, zoom=9)
+with timings.section('map'):
+    data = trip_points(pickup, dropoff)
+    st.map(data=data, zoom=9)
 
 
 # map_heatmap = folium.Map(location=[pick_lat, pick_long], zoom_start=11)
@@ -85,8 +113,9 @@ st.markdown("<h3 style='text-align: center; color: black;'>Data supplied by user
             unsafe_allow_html=True)
 cols1 = ['time_of_day', 'day_of_week', 'dayofmonth', 'dayofyear', ]
 cols2 = ['longitude', 'latitude', 'dist', 'trip_distance', ]
-st.table(prepared_data[cols1], )
-st.table(prepared_data[cols2], )
+with timings.section('tables'):
+    st.table(prepared_data[cols1], )
+    st.table(prepared_data[cols2], )
 
 # Select coordinates
 _, col2, _ = st.beta_columns([1, 3, 2])
@@ -98,3 +127,5 @@ with col2:
 _, col2, _ = st.beta_columns(3)
 with col2:
     st.button('Pick Coordinates')
+
+st.caption(timings.summary())
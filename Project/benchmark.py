@@ -0,0 +1,247 @@
+"""
+Benchmarks for the ingestion, feature and inference hot paths.
+
+    python benchmark.py --rows 200000 --out bench.json
+    python benchmark.py --rows 200000 --out bench.json --baseline previous.json
+
+Every stage runs on synthetic yellow cab trips (synthetic_trips), so no data
+download or network access is needed and runs with the same --rows and
+--seed are comparable. For each stage the result has the rows processed,
+the latency percentiles of --repeat runs, the throughput at the median and
+the peak memory traced by tracemalloc during one extra run.
+Per call stages (prepare_data, calculate_distance, single row predictions)
+time one call per run.
+
+With --baseline, every stage whose median latency grew by more than
+--threshold (20% by default) is reported and the exit status is 1.
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, time as dtime
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+import sklearn
+
+import helper
+import import_dataset
+from forest_engine import FlatForest
+from train import DTYPE, PARSE_DATES, USECOLS, make_estimator
+
+
+def synthetic_trips(n, seed=0, dirty=0.05):
+    """
+    n yellow cab trips with the columns and dtypes load_data returns. Most
+    trips pass basic_preprocessing; a `dirty` fraction breaks one of its rules.
+    """
+    rng = np.random.default_rng(seed)
+    pickup = (pd.Timestamp('2015-01-01')
+              + pd.to_timedelta(rng.integers(0, 365 * 86400, n), unit='s'))
+    minutes = rng.gamma(2.0, 7.0, n) + 1
+    distance = np.round(minutes * rng.uniform(0.1, 0.4, n), 2)
+    fare = np.round(2.5 + 2.5 * distance, 2)
+    extra = rng.choice([0, 0.5, 1], n)
+    tip = np.round(rng.uniform(0, 5, n) * (rng.random(n) < 0.6), 2)
+    tolls = rng.choice([0] * 20 + [5.54, 7.5, 8, 10.66, 15, 2.44, 5.33, 3.3], n)
+    df = pd.DataFrame({
+        'VendorID': rng.choice(['1', '2'], n),
+        'tpep_pickup_datetime': pickup,
+        'tpep_dropoff_datetime': pickup + pd.to_timedelta(minutes * 60, unit='s').round('s'),
+        'passenger_count': rng.choice([1, 1, 1, 1, 2, 3, 5, 6], n),
+        'trip_distance': distance,
+        'pickup_longitude': rng.uniform(-74.02, -73.75, n),
+        'pickup_latitude': rng.uniform(40.60, 40.88, n),
+        'RateCodeID': rng.choice(['1'] * 18 + ['2', '5'], n),
+        'store_and_fwd_flag': rng.choice(['N'] * 19 + ['Y'], n),
+        'dropoff_longitude': rng.uniform(-74.02, -73.75, n),
+        'dropoff_latitude': rng.uniform(40.60, 40.88, n),
+        'payment_type': rng.choice(['1', '1', '2', '3', '4'], n),
+        'fare_amount': fare,
+        'extra': extra,
+        'mta_tax': 0.5,
+        'tip_amount': tip,
+        'tolls_amount': tolls,
+        'improvement_surcharge': 0.3,
+        'total_amount': np.round(fare + extra + 0.5 + tip + tolls + 0.3, 2),
+    })
+    dirty = np.flatnonzero(rng.random(n) < dirty)
+    broken = rng.choice(['fare_amount', 'passenger_count', 'pickup_latitude', 'RateCodeID'],
+                        len(dirty))
+    for col, value in (('fare_amount', -1.0), ('passenger_count', 0),
+                       ('pickup_latitude', 0.0), ('RateCodeID', '99')):
+        df.loc[dirty[broken == col], col] = value
+    return df[USECOLS]
+
+
+def percentiles(times):
+    times = np.asarray(times)
+    return {'mean': float(times.mean()), 'p50': float(np.percentile(times, 50)),
+            'p95': float(np.percentile(times, 95)), 'p99': float(np.percentile(times, 99))}
+
+
+def measure(fn, setup=lambda: (), rows=1, repeat=5):
+    """
+    Time fn(*setup()) repeat times (setup is not timed), then once more
+    under tracemalloc for the peak memory.
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    args = setup()
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = percentiles(times)
+    return {'rows': rows, 'runs': repeat, 'seconds': stats,
+            'rows_per_second': rows / stats['p50'] if stats['p50'] else None,
+            'peak_mb': peak / 2**20}
+
+
+def fit_model(trips, n_estimators=10, max_depth=15):
+    # Notebook pipeline fitted on synthetic trips, as a stand-in for model.joblib
+    trips = trips[(trips['duration'] > 1) & (trips['duration'] <= 65)]
+    model = make_estimator()
+    model.set_params(model__regressor__n_estimators=n_estimators,
+                     model__regressor__max_depth=max_depth)
+    return model.fit(helper.prepare_trips(trips), trips['duration'].to_numpy())
+
+
+def quiet(fn):
+    # basic_preprocessing and load_data print their progress
+    def run(*args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return fn(*args, **kwargs)
+    return run
+
+
+def run(rows=100_000, repeat=5, calls=200, seed=0, stages=None, model_path=None):
+    """
+    Benchmark every stage (or the ones named in stages).
+    Returns {'meta': {...}, 'results': {stage: measurements}}.
+    """
+    raw = synthetic_trips(rows, seed)
+    clean = quiet(import_dataset.basic_preprocessing)(raw.copy())
+    model = joblib.load(model_path) if model_path else fit_model(clean)
+    engine = FlatForest.from_pipeline(model)
+    features = helper.prepare_trips(clean)
+    one_row = features.iloc[:1]
+    pickup, dropoff = (40.7484, -73.9857), (40.6413, -73.7781)
+
+    tmp = tempfile.TemporaryDirectory()
+    csv = Path(tmp.name) / 'yellow_tripdata_synthetic.csv'
+    raw.to_csv(csv, index=False)
+
+    benches = {
+        'load_data': lambda: measure(
+            lambda: quiet(import_dataset.load_data)(
+                path_dir=csv.parent, filename=csv.name, parse_dates=PARSE_DATES,
+                usecols=USECOLS, dtype=DTYPE, skiprows=1),
+            rows=rows, repeat=repeat),
+        'basic_preprocessing': lambda: measure(
+            quiet(import_dataset.basic_preprocessing), lambda: (raw.copy(),),
+            rows=rows, repeat=repeat),
+        'add_crow_direction': lambda: measure(
+            import_dataset.add_crow_direction, lambda: (clean.copy(),),
+            rows=len(clean), repeat=repeat),
+        'add_toll_source': lambda: measure(
+            import_dataset.add_toll_source, lambda: (clean.copy(),),
+            rows=len(clean), repeat=repeat),
+        'prepare_trips': lambda: measure(
+            helper.prepare_trips, lambda: (clean,), rows=len(clean), repeat=repeat),
+        'prepare_data': lambda: measure(
+            helper.prepare_data, lambda: (pickup, dropoff, 12.0, date(2015, 6, 1),
+                                          dtime(8, 30), 1), repeat=calls),
+        'calculate_distance': lambda: measure(
+            helper.calculate_distance, lambda: (pickup, dropoff), repeat=calls),
+        'geodesic_distance': lambda: measure(
+            helper.geodesic_distance, lambda: (pickup, dropoff), repeat=calls),
+        'predict_batch': lambda: measure(
+            model.predict, lambda: (features,), rows=len(features), repeat=repeat),
+        'predict_one': lambda: measure(model.predict, lambda: (one_row,), repeat=calls),
+        'engine_predict_batch': lambda: measure(
+            engine.predict, lambda: (features,), rows=len(features), repeat=repeat),
+        'engine_predict_one': lambda: measure(engine.predict, lambda: (one_row,),
+                                              repeat=calls),
+    }
+    results = {}
+    with tmp:
+        for name, bench in benches.items():
+            if stages and name not in stages:
+                continue
+            results[name] = bench()
+            r = results[name]
+            print(f"{name:22s} p50 {r['seconds']['p50'] * 1000:9.3f} ms  "
+                  f"p95 {r['seconds']['p95'] * 1000:9.3f} ms  "
+                  f"{r['rows_per_second'] or 0:12.0f} rows/s  peak {r['peak_mb']:7.1f} MB")
+    meta = {'rows': rows, 'repeat': repeat, 'calls': calls, 'seed': seed,
+            'time': pd.Timestamp.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'numpy': np.__version__, 'pandas': pd.__version__,
+            'scikit-learn': sklearn.__version__}
+    return {'meta': meta, 'results': results}
+
+
+def compare(current, baseline, threshold=0.2):
+    """
+    Stages whose median latency is more than `threshold` (a fraction) above
+    the baseline's, as (stage, baseline p50, current p50) tuples.
+    """
+    regressions = []
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        old, new = before['seconds']['p50'], result['seconds']['p50']
+        change = new / old - 1 if old else 0
+        print(f"{name:22s} {old * 1000:9.3f} ms -> {new * 1000:9.3f} ms ({change:+.0%})")
+        if change > threshold:
+            regressions.append((name, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the data and inference hot paths.')
+    parser.add_argument('--rows', type=int, default=100_000, help='synthetic trips per frame')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per batch stage')
+    parser.add_argument('--calls', type=int, default=200, help='runs per single call stage')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', help='only run these stages')
+    parser.add_argument('--model', help='benchmark this model.joblib instead of one '
+                                        'fitted on the synthetic trips')
+    parser.add_argument('--out', help='write the results to this json file')
+    parser.add_argument('--baseline', help='results json to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed median latency increase over the baseline')
+    args = parser.parse_args()
+
+    report = run(args.rows, args.repeat, args.calls, args.seed, args.stages, args.model)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.out}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.baseline}:")
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} stages slower than the baseline by more than "
+                  f"{args.threshold:.0%}: {', '.join(name for name, _, _ in regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+Flattened inference engine for the trip duration pipeline.
+
+Build_Model.ipynb produces
+    Pipeline([('preparation', ColumnTransformer([StandardScaler on the numeric
+                                                  columns, OrdinalEncoder on
+                                                  day_of_week])),
+              ('model', TransformedTargetRegressor(RandomForestRegressor,
+                                                   log10 / exp10))])
+FlatForest copies everything predict needs into plain NumPy arrays (scaler
+mean/scale, encoder categories, the node tables of all trees concatenated)
+and walks every tree for every row at once, without scikit-learn's per-call
+validation. Predictions match Pipeline.predict to floating point tolerance.
+
+The arrays are saved as .npy files in a directory, so that
+FlatForest.load(path, mmap_mode='r') maps them and worker processes share
+them through the page cache.
+
+Walking the trees with NumPy beats scikit-learn's per-call overhead on
+small inputs but not its compiled tree walk on large ones. Given the
+pipeline (or its path, loaded on first use), predict hands inputs of
+batch_rows rows or more to it.
+"""
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from scipy import special
+
+
+ARRAYS = ['mean', 'scale', 'feature', 'threshold', 'children', 'value', 'roots']
+INVERSE_FUNCS = {'exp10': special.exp10, 'identity': lambda y: y}
+# Inputs up to this many rows skip pandas in transform
+SMALL_ROWS = 16
+
+
+class FlatForest:
+
+    def __init__(self, columns, num_ix, cat_ix, categories, mean, scale, feature,
+                 threshold, children, value, roots, max_depth, inverse='exp10',
+                 chunksize=4096, pipeline=None, batch_rows=4096):
+        self.columns = list(columns)
+        self.num_ix = list(num_ix)
+        self.cat_ix = list(cat_ix)
+        self.categories = [list(c) for c in categories]
+        self.lookups = [{c: i for i, c in enumerate(cats)} for cats in self.categories]
+        # np.asarray keeps memory-mapped arrays mapped, but indexing a plain
+        # ndarray is much cheaper than indexing a np.memmap
+        self.mean = np.asarray(mean)
+        self.scale = np.asarray(scale)
+        self.feature = np.asarray(feature)
+        self.threshold = np.asarray(threshold)
+        self.children = np.asarray(children)
+        self.value = np.asarray(value)
+        self.roots = np.asarray(roots)
+        self.max_depth = int(max_depth)
+        self.inverse = inverse
+        self.inverse_func = INVERSE_FUNCS[inverse]
+        self.chunksize = chunksize
+        self.pipeline = pipeline
+        self.batch_rows = batch_rows
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_pipeline(cls, pipeline, columns=None):
+        """
+        Flatten a fitted Pipeline(ColumnTransformer -> TransformedTargetRegressor
+        (RandomForestRegressor)). columns are the input column names, in the
+        order of the rows passed to predict (default: helper.cols).
+        """
+        if columns is None:
+            from helper import cols as columns
+        preparation, model = pipeline.steps[0][1], pipeline.steps[-1][1]
+
+        num_ix, cat_ix, mean, scale, categories = [], [], None, None, []
+        for name, transformer, ix in preparation.transformers_:
+            if transformer == 'drop':
+                continue
+            step = transformer.steps[-1][1] if hasattr(transformer, 'steps') else transformer
+            kind = type(step).__name__
+            if kind == 'StandardScaler' and cat_ix:
+                # transform puts the scaled columns first, as the notebook's pipeline does
+                raise ValueError(f"Unsupported column order: {name} comes after the "
+                                 f"categorical columns")
+            if kind == 'StandardScaler' and not num_ix:
+                num_ix = list(ix)
+                mean = step.mean_ if step.mean_ is not None else np.zeros(len(ix))
+                scale = step.scale_ if step.scale_ is not None else np.ones(len(ix))
+            elif kind == 'OrdinalEncoder' and not cat_ix:
+                cat_ix = list(ix)
+                categories = [list(c) for c in step.categories_]
+            else:
+                raise ValueError(f"Unsupported transformer {name}: {kind}")
+
+        if hasattr(model, 'regressor_'):
+            forest = model.regressor_
+            inverse = next((k for k, f in INVERSE_FUNCS.items()
+                            if f is model.inverse_func), None)
+            if inverse is None:
+                raise ValueError(f"Unsupported inverse_func {model.inverse_func}")
+        else:
+            forest, inverse = model, 'identity'
+
+        feature, threshold, children, value, roots = [], [], [], [], []
+        offset = 0
+        for estimator in forest.estimators_:
+            tree = estimator.tree_
+            n = tree.node_count
+            is_leaf = tree.children_left == -1
+            nodes = np.arange(offset, offset + n)
+            # children[2 * node + (x <= threshold)] is the next node: right
+            # child first, then left. Leaves point to themselves so extra
+            # iterations are no-ops.
+            children.append(np.column_stack([
+                np.where(is_leaf, nodes, tree.children_right + offset),
+                np.where(is_leaf, nodes, tree.children_left + offset)]).ravel())
+            feature.append(np.where(is_leaf, 0, tree.feature))
+            threshold.append(tree.threshold)
+            value.append(tree.value[:, 0, 0])
+            roots.append(offset)
+            offset += n
+        max_depth = max(e.tree_.max_depth for e in forest.estimators_)
+        return cls(columns, num_ix, cat_ix, categories,
+                   np.asarray(mean, dtype=np.float64), np.asarray(scale, dtype=np.float64),
+                   np.concatenate(feature).astype(np.int32),
+                   np.concatenate(threshold).astype(np.float64),
+                   np.concatenate(children).astype(np.int32),
+                   np.concatenate(value).astype(np.float64),
+                   np.asarray(roots, dtype=np.int32), max_depth, inverse)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        meta = {'columns': self.columns, 'num_ix': self.num_ix, 'cat_ix': self.cat_ix,
+                'categories': self.categories, 'max_depth': self.max_depth,
+                'inverse': self.inverse}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return path
+
+    @classmethod
+    def load(cls, path, mmap_mode='r', pipeline=None):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+                  for name in ARRAYS}
+        return cls(**meta, **arrays, pipeline=pipeline)
+
+    def transform(self, X):
+        """
+        Scaled numeric columns followed by the encoded categorical columns,
+        as float32 (the dtype the trees compare against).
+        """
+        if isinstance(X, pd.DataFrame):
+            if len(X) > SMALL_ROWS:
+                return self.transform_columns(X)
+            X = X.to_numpy(dtype=object)
+        rows = np.asarray(X, dtype=object).reshape(-1, len(self.columns))
+        if len(rows) > SMALL_ROWS:
+            return self.transform_columns(pd.DataFrame(rows, columns=self.columns))
+        return self.transform_rows(rows)
+
+    def transform_rows(self, rows):
+        # A few rows as an object array: plain NumPy and dict lookups, no pandas
+        Xt = np.empty((len(rows), len(self.num_ix) + len(self.cat_ix)), dtype=np.float32)
+        Xt[:, :len(self.num_ix)] = (rows[:, self.num_ix].astype(np.float64) - self.mean) / self.scale
+        for j, (i, lookup) in enumerate(zip(self.cat_ix, self.lookups), len(self.num_ix)):
+            for r, value in enumerate(rows[:, i]):
+                if value not in lookup:
+                    raise ValueError(f"Unknown category {value!r} in column {self.columns[i]}")
+                Xt[r, j] = lookup[value]
+        return Xt
+
+    def transform_columns(self, X):
+        # Column by column, by name: much cheaper than X.iloc[:, i] or an object array
+        names = X.columns
+        Xt = np.empty((len(X), len(self.num_ix) + len(self.cat_ix)), dtype=np.float32)
+        for j, i in enumerate(self.num_ix):
+            Xt[:, j] = (X[names[i]].to_numpy(dtype=np.float64) - self.mean[j]) / self.scale[j]
+        for j, (i, lookup) in enumerate(zip(self.cat_ix, self.lookups), len(self.num_ix)):
+            # Encode the distinct values only, as import_dataset.to_categorical does;
+            # the trailing -1 keeps missing values (code -1) unknown
+            codes, uniques = pd.factorize(X[names[i]])
+            lut = np.array([lookup.get(u, -1) for u in uniques] + [-1])
+            codes = lut[codes]
+            if (codes < 0).any():
+                unknown = X[names[i]].to_numpy()[codes < 0][0]
+                raise ValueError(f"Unknown category {unknown!r} in column {self.columns[i]}")
+            Xt[:, j] = codes
+        return Xt
+
+    def predict_transformed(self, Xt):
+        out = np.empty(len(Xt), dtype=np.float64)
+        n_trees = len(self.roots)
+        for start in range(0, len(Xt), self.chunksize):
+            X = np.ascontiguousarray(Xt[start:start + self.chunksize])
+            n, n_features = X.shape
+            flat = X.ravel()
+            # One entry per (row, tree): current node and offset of the row in flat
+            node = np.tile(self.roots, n)
+            base = np.repeat(np.arange(n) * n_features, n_trees)
+            active = np.arange(n * n_trees)
+            for _ in range(self.max_depth):
+                current = node[active]
+                go_left = flat[base[active] + self.feature[current]] <= self.threshold[current]
+                node[active] = nxt = self.children[2 * current + go_left]
+                # Entries that stayed put have reached a leaf
+                active = active[nxt != current]
+                if not active.size:
+                    break
+            out[start:start + n] = self.value[node].reshape(n, n_trees).sum(axis=1) / n_trees
+        return self.inverse_func(out)
+
+    def batch_model(self):
+        # The pipeline, loaded from its path on first use
+        with self.lock:
+            if isinstance(self.pipeline, (str, os.PathLike)):
+                import joblib
+                path = os.fspath(self.pipeline)
+                self.pipeline = joblib.load(
+                    path, mmap_mode='r' if path.endswith('.mmap.joblib') else None)
+        return self.pipeline
+
+    def predict(self, X):
+        if self.pipeline is not None and len(X) >= self.batch_rows:
+            if not isinstance(X, pd.DataFrame):
+                X = pd.DataFrame(np.asarray(X, dtype=object).reshape(-1, len(self.columns)),
+                                 columns=self.columns)
+            return self.batch_model().predict(X)
+        return self.predict_transformed(self.transform(X))
@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+from geopy.distance import geodesic, great_circle
+
+
+# WGS-84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+
+# Same mean earth radius and km -> miles factor used by geopy
+EARTH_RADIUS_KM = 6371.009
+KM_PER_MILE = 1.609344
+
+
+def geodesic_miles(lat1, lon1, lat2, lon2, tol=1e-12, max_iter=200):
+    """
+    WGS-84 geodesic distance in miles between arrays of points, using
+    Vincenty's inverse formula. Pairs where the iteration does not converge
+    (nearly antipodal points) fall back to geopy.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.asarray(x, dtype=float)
+                                                  for x in (lat1, lon1, lat2, lon2)))
+    shape = lat1.shape
+    lat1, lon1, lat2, lon2 = (x.ravel() for x in (lat1, lon1, lat2, lon2))
+    a, b, f = WGS84_A, WGS84_B, WGS84_F
+    L = np.radians(lon2 - lon1)
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L
+    converged = np.zeros(L.shape, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cosU2 * sin_lam,
+                                 cosU1 * sinU2 - sinU1 * cosU2 * cos_lam)
+            cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0,
+                                 cosU1 * cosU2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines have cos2_alpha == 0
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0,
+                                    cos_sigma - 2 * sinU1 * sinU2 / cos2_alpha)
+            C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * f * sin_alpha * (
+                sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma *
+                                         (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam - lam_prev) <= tol
+            if converged.all():
+                break
+
+        u2 = cos2_alpha * (a ** 2 - b ** 2) / b ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+            B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) *
+            (-3 + 4 * cos_2sigma_m ** 2)))
+        meters = b * A * (sigma - delta_sigma)
+
+    miles = meters / 1000 / KM_PER_MILE
+    for i in np.flatnonzero(~converged & np.isfinite(L)):
+        miles[i] = geodesic((lat1[i], lon1[i]), (lat2[i], lon2[i]),
+                            ellipsoid='WGS-84').miles
+    return miles.reshape(shape)
+
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in miles between arrays of points on a sphere
+    with the mean earth radius.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=float))
+                              for x in (lat1, lon1, lat2, lon2))
+    h = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    km = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+    return km / KM_PER_MILE
+
+
+METRICS = {'geodesic': geodesic_miles,
+           'haversine': haversine_miles, }
+
+
+def trip_distances(pickup, dropoff, metrics=('geodesic',)):
+    """
+    Distances in miles for N pickup/dropoff pairs.
+    pickup and dropoff are sequences (or N x 2 arrays) of (latitude, longitude).
+    Only the requested metrics are computed; returns a dict of arrays.
+    """
+    pickup = np.asarray(pickup, dtype=float).reshape(-1, 2)
+    dropoff = np.asarray(dropoff, dtype=float).reshape(-1, 2)
+    return {name: METRICS[name](pickup[:, 0], pickup[:, 1],
+                                dropoff[:, 0], dropoff[:, 1])
+            for name in metrics}
+
+
+def compare_with_geopy(n=1000, lat=(40.5612, 40.9637), lon=(-74.1923, -73.5982),
+                       seed=42):
+    """
+    Validate the array metrics against geopy on n random pairs inside the
+    given bounding box. Returns the max absolute and relative error per metric.
+    """
+    rng = np.random.default_rng(seed)
+    pickup = np.column_stack([rng.uniform(*lat, n), rng.uniform(*lon, n)])
+    dropoff = np.column_stack([rng.uniform(*lat, n), rng.uniform(*lon, n)])
+    ours = trip_distances(pickup, dropoff, metrics=list(METRICS))
+    reference = {
+        'geodesic': [geodesic(p, d, ellipsoid='WGS-84').miles
+                     for p, d in zip(pickup, dropoff)],
+        'haversine': [great_circle(p, d).miles for p, d in zip(pickup, dropoff)],
+    }
+    rows = []
+    for name in METRICS:
+        expected = np.asarray(reference[name])
+        err = np.abs(ours[name] - expected)
+        rows.append({'metric': name,
+                     'max_abs_error_miles': err.max(),
+                     'max_rel_error': (err / np.maximum(expected, 1e-12)).max()})
+    return pd.DataFrame(rows).set_index('metric')
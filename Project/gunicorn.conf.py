@@ -0,0 +1,12 @@
+# gunicorn -c gunicorn.conf.py serve:app
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Sync workers: each request is a short CPU-bound predict call
+worker_class = 'sync'
+keepalive = 5
+# Load the model in the master before forking so workers share its memory
+preload_app = True
+timeout = 30
@@ -1,7 +1,9 @@
-import math
+from datetime import datetime
+from functools import lru_cache
 import pandas as pd
 import numpy as np
 from geopy.distance import distance, geodesic, great_circle
+from geodistance import geodesic_miles
 
 
 cols = ['longitude', 'latitude', 'dist', 'trip_distance',
@@ -22,19 +24,73 @@ def calculate_distance(pickup, dropoff):
     return dist1, dist2, dist3
 
 
+def geodesic_distance(pickup, dropoff):
+    # WGS-84 geodesic distance in miles, the only metric the apps use
+    return float(geodesic_miles(pickup[0], pickup[1], dropoff[0], dropoff[1]))
+
+
 def prepare_data(pickup, dropoff, trip_dist, dt, tmd, passenger):
-    longg = pickup[1] - dropoff[1]
-    lat = pickup[0] - dropoff[0]
-    dist = math.sqrt(math.pow(longg, 2) + math.pow(lat, 2))
-    longitude = math.sqrt(math.pow(longg, 2))
-    ltitude = math.sqrt(math.pow(lat, 2))
-    time_of_day = tmd.hour
-    day_of_week = pd.to_datetime(dt).day_name()
-    dayofmonth = dt.day
-    dayofyear = pd.to_datetime(dt).dayofyear
-    val = [longitude, ltitude, dist, trip_dist, time_of_day,
-           day_of_week, passenger, dayofmonth, dayofyear]
-    data = pd.DataFrame(np.array([val]), columns=cols)
-    data = data.astype(dtype)
-    # print(data.values.tolist())
+    pickup_datetime = datetime.combine(dt, tmd)
+    return prepare_batch([pickup], [dropoff], [trip_dist],
+                         [pickup_datetime], [passenger])
+
+
+def prepare_batch(pickup, dropoff, trip_dist, pickup_datetime, passenger):
+    """
+    Build the model features for many trips in one vectorized pass.
+    pickup and dropoff are sequences (or an N x 2 array) of (latitude, longitude)
+    pairs, the other arguments are sequences of length N.
+    Returns a DataFrame with the `cols` columns and `dtype` dtypes.
+    """
+    pickup = np.asarray(pickup, dtype=float).reshape(-1, 2)
+    dropoff = np.asarray(dropoff, dtype=float).reshape(-1, 2)
+    longg = pickup[:, 1] - dropoff[:, 1]
+    lat = pickup[:, 0] - dropoff[:, 0]
+    when = pd.DatetimeIndex(pd.to_datetime(pickup_datetime))
+    data = pd.DataFrame({'longitude': np.sqrt(np.square(longg)),
+                         'latitude': np.sqrt(np.square(lat)),
+                         'dist': np.sqrt(np.square(longg) + np.square(lat)),
+                         'trip_distance': np.asarray(trip_dist, dtype=float),
+                         'time_of_day': when.hour,
+                         'day_of_week': when.day_name(),
+                         'passenger_count': np.asarray(passenger),
+                         'dayofmonth': when.day,
+                         'dayofyear': when.dayofyear,
+                         }, columns=cols)
+    return data.astype(dtype)
+
+
+def prepare_trips(df):
+    """
+    Build the model features from a trip table using the TLC column names
+    (pickup_latitude, pickup_longitude, dropoff_latitude, dropoff_longitude,
+    trip_distance, tpep_pickup_datetime, passenger_count).
+    """
+    pickup = np.column_stack([df['pickup_latitude'], df['pickup_longitude']])
+    dropoff = np.column_stack([df['dropoff_latitude'], df['dropoff_longitude']])
+    data = prepare_batch(pickup, dropoff, df['trip_distance'],
+                         df['tpep_pickup_datetime'], df['passenger_count'])
+    data.index = df.index
     return data
+
+
+# Memoized versions for the Streamlit apps, which rerun the whole script on
+# every widget change. They live here because functions defined in the app
+# script are redefined (and their caches lost) on each rerun.
+# The returned DataFrames are shared and must not be modified.
+@lru_cache(maxsize=1024)
+def cached_distance(pickup, dropoff):
+    return geodesic_distance(pickup, dropoff)
+
+
+@lru_cache(maxsize=1024)
+def cached_features(pickup, dropoff, trip_dist, dt, tmd, passenger):
+    return prepare_data(pickup, dropoff, trip_dist, dt, tmd, passenger)
+
+
+@lru_cache(maxsize=1024)
+def trip_points(pickup, dropoff):
+    # Pickup and dropoff as the latitude/longitude table st.map expects
+    return pd.DataFrame({'latitude': [pickup[0], dropoff[0]],
+                         'longitude': [pickup[1], dropoff[1]]},
+                        index=['Pickup', 'Dropoff'])
@@ -1,7 +1,16 @@
+import hashlib
+import json
 import math
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
 from pyproj import Geod
 
+import metrics
+from metrics import instrument
+
 
 # Bounding latitude/longitude
 lat = [40.5612, 40.9637]
@@ -25,93 +34,375 @@ RateCode = {"1": "Standard rate",
 VendorID = {"1": "Creative Mobile Technologies, LLC",
             "2": "VeriFone Inc.", }
 
+# Compact dtypes applied while reading the yellow trip files.
+# float32 keeps coordinates to ~1 m and charges to well under a cent.
+# The categories are fixed so that files with different codes still
+# concatenate to categoricals; unknown codes read as missing, which
+# basic_preprocessing drops like any code missing from the mappings.
+TRIP_SCHEMA = {'VendorID': pd.CategoricalDtype(list(VendorID)),
+               'passenger_count': 'float32',
+               'trip_distance': 'float32',
+               'pickup_longitude': 'float32',
+               'pickup_latitude': 'float32',
+               'RateCodeID': pd.CategoricalDtype(list(RateCode)),
+               'store_and_fwd_flag': pd.CategoricalDtype(['N', 'Y']),
+               'dropoff_longitude': 'float32',
+               'dropoff_latitude': 'float32',
+               'payment_type': pd.CategoricalDtype(list(Payment_Type)),
+               'fare_amount': 'float32',
+               'extra': 'float32',
+               'mta_tax': 'float32',
+               'tip_amount': 'float32',
+               'tolls_amount': 'float32',
+               'improvement_surcharge': 'float32',
+               'total_amount': 'float32', }
+
+
+def data_files(path_dir, file_substr='yellow'):
+    # Sorted so that results do not depend on directory listing order
+    return sorted(f for f in path_dir.iterdir() if f'{file_substr}' in str(f))
+
+
+def apply_schema(df):
+    """
+    Finish the compact schema once a file (or chunk) is read: passenger
+    counts become int16 (missing counts become 0, which basic_preprocessing
+    drops) and store_and_fwd_flag becomes a boolean.
+    int8 would wrap the out of range counts found in the raw history (208
+    becomes -48); int16 keeps them, so compact and default loads keep the
+    same rows.
+    """
+    if 'passenger_count' in df:
+        counts = df['passenger_count'].fillna(0).clip(-2**15, 2**15 - 1)
+        df['passenger_count'] = counts.astype('int16')
+    if 'store_and_fwd_flag' in df:
+        df['store_and_fwd_flag'] = (df['store_and_fwd_flag'] == 'Y').to_numpy()
+    return df
+
 
+def read_trips(path, parse_dates=None, usecols=None, dtype=None, skiprows=0,
+               compact=False, chunksize=None, nrows=None):
+    """
+    pd.read_csv with the arguments load_data uses.
+    With compact=True columns are read with TRIP_SCHEMA dtypes, overriding dtype.
+    Returns a DataFrame, or an iterator of DataFrames when chunksize is set.
+    """
+    if compact:
+        dtype = {**(dtype or {}), **TRIP_SCHEMA}
+    data = pd.read_csv(path, parse_dates=parse_dates, names=usecols, dtype=dtype,
+                       low_memory=False, skiprows=skiprows, chunksize=chunksize,
+                       nrows=nrows)
+    if not compact:
+        return data
+    if chunksize:
+        return (apply_schema(chunk) for chunk in data)
+    return apply_schema(data)
+
+
+@instrument
 def load_data(path_dir=None, filename=None, parse_dates=None,
               usecols=None, dtype=None, low_memory=False,
-              file_substr='yellow', skiprows=0, preprocess=False):
+              file_substr='yellow', skiprows=0, preprocess=False, workers=None,
+              compact=False):
+    """
+    Load one file, or all file_substr*.csv files in path_dir.
+    With workers > 1 the files are read (and preprocessed) in a pool of
+    worker processes and merged in file name order.
+    compact=True reads the columns with the TRIP_SCHEMA dtypes.
+    """
     if filename:
         print(f"Loading {filename}...\n")
-        df = pd.read_csv(path_dir / filename, parse_dates=parse_dates,
-                         names=usecols, dtype=dtype, low_memory=False,
-                         skiprows=skiprows)
+        df = read_trips(path_dir / filename, parse_dates=parse_dates,
+                        usecols=usecols, dtype=dtype, skiprows=skiprows,
+                        compact=compact)
+    elif workers and workers > 1:
+        print(f"Loading all {file_substr}*.csv in {path_dir} folder with {workers} workers...\n")
+        files = data_files(path_dir, file_substr)
+        frames = [None] * len(files)
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(load_file, f, parse_dates=parse_dates,
+                                   usecols=usecols, dtype=dtype, skiprows=skiprows,
+                                   preprocess=preprocess, compact=compact): i
+                       for i, f in enumerate(files)}
+            for done, future in enumerate(as_completed(futures), 1):
+                i = futures[future]
+                frames[i], elapsed = future.result()
+                print(f"[{done}/{len(files)}] {files[i].name}: "
+                      f"{len(frames[i])} rows in {elapsed:.1f}s")
+        print(f"Loaded {len(files)} files in {time.perf_counter() - start:.1f}s\n")
+        # Each file has already been preprocessed by its worker
+        return pd.concat(frames, ignore_index=True)
     else:
         print(f"Loading all {file_substr}*.csv in {path_dir} folder...\n")
-        df_from_each_file = (pd.read_csv(f, parse_dates=parse_dates,
-                                         names=usecols, dtype=dtype,
-                                         low_memory=False,
-                                         skiprows=skiprows)
-                             for f in path_dir.iterdir()
-                             if f'{file_substr}' in str(f))
+        df_from_each_file = (read_trips(f, parse_dates=parse_dates,
+                                        usecols=usecols, dtype=dtype,
+                                        skiprows=skiprows, compact=compact)
+                             for f in data_files(path_dir, file_substr))
         df = pd.concat(df_from_each_file, ignore_index=True)
     if preprocess:
-        df = basic_preprocessing(df)
+        # basic_preprocessing already returns a fresh RangeIndex
+        return basic_preprocessing(df)
     df.reset_index(inplace=True, drop=True)
     return df
 
 
-def basic_preprocessing(df=None):
-    print('Converting categorical features to their corresponding values...\n')
-    df.loc[:, 'payment_type'] = df['payment_type'].apply(lambda x: Payment_Type[x])
-    df.loc[:, 'RateCodeID'] = df['RateCodeID'].apply(lambda x: RateCode[x])
-    df.loc[:, 'VendorID'] = df['VendorID'].apply(lambda x: VendorID[x])
+def load_file(path, parse_dates=None, usecols=None, dtype=None, skiprows=0,
+              preprocess=False, compact=False):
+    # Worker task for load_data: returns the loaded file and the seconds it took
+    start = time.perf_counter()
+    df = read_trips(path, parse_dates=parse_dates, usecols=usecols, dtype=dtype,
+                    skiprows=skiprows, compact=compact)
+    if preprocess:
+        df = basic_preprocessing(df, verbose=False)
+    return df, time.perf_counter() - start
+
+
+def estimate_chunksize(path, max_memory, parse_dates=None, usecols=None,
+                       dtype=None, skiprows=0, compact=False, sample_rows=10_000,
+                       overhead=4):
+    """
+    Number of rows per chunk so that a chunk, and the copies made while
+    preprocessing and adding features (overhead), stay below max_memory bytes.
+    """
+    sample = read_trips(path, parse_dates=parse_dates, usecols=usecols,
+                        dtype=dtype, skiprows=skiprows, compact=compact,
+                        nrows=sample_rows)
+    row_bytes = sample.memory_usage(deep=True).sum() / max(len(sample), 1)
+    return max(1, int(max_memory / (row_bytes * overhead)))
+
+
+def iter_data(path_dir=None, filename=None, parse_dates=None,
+              usecols=None, dtype=None, file_substr='yellow', skiprows=0,
+              preprocess=True, features=(), chunksize=None, max_memory=None,
+              compact=False):
+    """
+    Streaming version of load_data.
+    Reads each file in chunks of chunksize rows (or as many rows as fit in
+    max_memory bytes), runs basic_preprocessing and each function in features
+    (e.g. add_timeof_day, add_dayof_week, add_crow_direction) on every chunk
+    and yields the processed chunks.
+    """
+    files = [path_dir / filename] if filename else data_files(path_dir, file_substr)
+    for f in files:
+        if max_memory:
+            chunksize = estimate_chunksize(f, max_memory, parse_dates=parse_dates,
+                                           usecols=usecols, dtype=dtype,
+                                           skiprows=skiprows, compact=compact)
+        print(f"Streaming {f.name} in chunks of {chunksize} rows...\n")
+        reader = read_trips(f, parse_dates=parse_dates, usecols=usecols,
+                            dtype=dtype, skiprows=skiprows, compact=compact,
+                            chunksize=chunksize or 1_000_000)
+        for chunk in reader:
+            if preprocess:
+                chunk = basic_preprocessing(chunk, verbose=False)
+            for add_feature in features:
+                chunk = add_feature(chunk)
+            yield chunk
+
+
+def stream_data(out_path, **kwargs):
+    """
+    Write the chunks of iter_data(**kwargs) straight to out_path, a .parquet
+    or .csv file, without holding more than one chunk in memory.
+    Returns the number of rows written.
+    """
+    return write_chunks(iter_data(**kwargs), out_path)
+
+
+def write_chunks(chunks, out_path):
+    # Append each DataFrame in chunks to a .parquet or .csv file
+    rows = 0
+    writer = None
+    try:
+        for chunk in chunks:
+            if out_path.suffix == '.parquet':
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                if writer is None:
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    writer = pq.ParquetWriter(out_path, table.schema)
+                else:
+                    table = pa.Table.from_pandas(chunk, schema=writer.schema,
+                                                 preserve_index=False)
+                writer.write_table(table)
+            else:
+                chunk.to_csv(out_path, mode='w' if rows == 0 else 'a',
+                             header=rows == 0, index=False)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    print(f"Wrote {rows} rows to {out_path}\n")
+    return rows
+
+
+def memory_report(path, parse_dates=None, usecols=None, dtype=None, skiprows=0,
+                  nrows=None):
+    """
+    Compare reading path with the default dtypes and with TRIP_SCHEMA.
+    Returns the in-memory bytes of every column under both schemas, plus a
+    'peak (traced)' row with the peak allocation seen while reading.
+    """
+    frames, peaks = {}, {}
+    for name, compact in [('default', False), ('compact', True)]:
+        tracemalloc.start()
+        frames[name] = read_trips(path, parse_dates=parse_dates, usecols=usecols,
+                                  dtype=dtype, skiprows=skiprows, compact=compact,
+                                  nrows=nrows)
+        peaks[name] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    report = pd.DataFrame({name: df.memory_usage(deep=True, index=False)
+                           for name, df in frames.items()})
+    report.loc['total'] = report.sum()
+    report.loc['peak (traced)'] = pd.Series(peaks)
+    report['ratio'] = report['default'] / report['compact']
+    return report
+
+
+def between(col, low, high):
+    return lambda df: (df[col] >= low) & (df[col] <= high)
+
+
+def charges_sum(df):
+    # Total is the sum of all charges
+    total = (df.fare_amount + df.extra + df.mta_tax + df.tip_amount +
+             df.tolls_amount + df.improvement_surcharge)
+    return (total - df.total_amount).abs() < 0.01
+
+
+# Validity rules applied by basic_preprocessing, in order.
+# Each entry is (progress message, rule name, function returning a boolean
+# Series of the rows to keep).
+FILTER_RULES = [
+    ('Converting categorical features to their corresponding values...',
+     'known VendorID/RateCodeID/payment_type',
+     lambda df: df.VendorID.notna() & df.RateCodeID.notna() & df.payment_type.notna()),
 
     # Remove invalid charges
     # Only keep trips (rows) containing valid charges.
-    print('Removing invalid charges...\n')
-    df.query('RateCodeID != "99"', inplace=True)
-    df.query('fare_amount > 0', inplace=True)
-    df.query('extra >= 0', inplace=True)
-    df.query('mta_tax >= 0', inplace=True)
-    df.query('tip_amount >= 0', inplace=True)
-    df.query('tolls_amount >= 0', inplace=True)
-    df.query('improvement_surcharge >= 0', inplace=True)
-    df.query('total_amount > 0', inplace=True)
+    ('Removing invalid charges...', 'RateCodeID != "99"', lambda df: df.RateCodeID != "99"),
+    ('Removing invalid charges...', 'fare_amount > 0', lambda df: df.fare_amount > 0),
+    ('Removing invalid charges...', 'extra >= 0', lambda df: df.extra >= 0),
+    ('Removing invalid charges...', 'mta_tax >= 0', lambda df: df.mta_tax >= 0),
+    ('Removing invalid charges...', 'tip_amount >= 0', lambda df: df.tip_amount >= 0),
+    ('Removing invalid charges...', 'tolls_amount >= 0', lambda df: df.tolls_amount >= 0),
+    ('Removing invalid charges...', 'improvement_surcharge >= 0',
+     lambda df: df.improvement_surcharge >= 0),
+    ('Removing invalid charges...', 'total_amount > 0', lambda df: df.total_amount > 0),
 
     # Only keep trips where charges match the expected values.
     # ImpSurcharge is $0.30
     # Tax is $0.50
-    # Total is the sum of all charges
-    df.query('abs(improvement_surcharge-0.3) < 0.01', inplace=True)
-    df.query('abs(mta_tax-0.5) < 0.01', inplace=True)
-    df.query('abs(fare_amount+extra+mta_tax+tip_amount+tolls_amount+improvement_surcharge-total_amount) < 0.01', inplace=True)
+    ('Removing invalid charges...', 'abs(improvement_surcharge-0.3) < 0.01',
+     lambda df: (df.improvement_surcharge - 0.3).abs() < 0.01),
+    ('Removing invalid charges...', 'abs(mta_tax-0.5) < 0.01',
+     lambda df: (df.mta_tax - 0.5).abs() < 0.01),
+    ('Removing invalid charges...', 'abs(sum of charges-total_amount) < 0.01', charges_sum),
 
     # Remove invalid trip information
     # Only keep trips with valid passenger and distance information.
-    print('Removing invalid trip information...\n')
-    df.query('passenger_count > 0', inplace=True)
-    df.query('trip_distance > 0', inplace=True)
+    ('Removing invalid trip information...', 'passenger_count > 0',
+     lambda df: df.passenger_count > 0),
+    ('Removing invalid trip information...', 'trip_distance > 0',
+     lambda df: df.trip_distance > 0),
 
     # Remove outliers
     # Only keep trips with pickup and drop off locations inside the region of interest.
-    print('Keep trips with pickup and drop off locations inside the region of interest\n')
-    df.query(f'pickup_longitude >= {lon[0]} & pickup_longitude <= {lon[1]}', inplace=True)
-    df.query(f'dropoff_longitude >= {lon[0]} & dropoff_longitude <= {lon[1]}', inplace=True)
-    df.query(f'pickup_latitude >= {lat[0]} & pickup_latitude <= {lat[1]}', inplace=True)
-    df.query(f'dropoff_latitude >= {lat[0]} & dropoff_latitude <= {lat[1]}', inplace=True)
+    ('Keep trips with pickup and drop off locations inside the region of interest',
+     'pickup_longitude in lon', between('pickup_longitude', *lon)),
+    ('Keep trips with pickup and drop off locations inside the region of interest',
+     'dropoff_longitude in lon', between('dropoff_longitude', *lon)),
+    ('Keep trips with pickup and drop off locations inside the region of interest',
+     'pickup_latitude in lat', between('pickup_latitude', *lat)),
+    ('Keep trips with pickup and drop off locations inside the region of interest',
+     'dropoff_latitude in lat', between('dropoff_latitude', *lat)),
+
+    # Only keep trips with typical values
+    # Typical trip
+    ('Only keep trips with typical values..', 'duration >= 1 & duration <= 120',
+     between('duration', 1, 120)),
+    ('Only keep trips with typical values..', 'trip_distance >= 0.01 & trip_distance <= 50',
+     between('trip_distance', 0.01, 50)),
+
+    # Typical charges
+    ('Only keep trips with typical values..', 'fare_amount >= 0.01 & fare_amount <= 100',
+     between('fare_amount', 0.01, 100)),
+    ('Only keep trips with typical values..', 'tolls_amount <= 20',
+     lambda df: df.tolls_amount <= 20),
+    ('Only keep trips with typical values..', 'total_amount >= 0.5 & total_amount <= 120',
+     between('total_amount', 0.5, 120)),
+]
+
+
+RULE_REJECTED = metrics.counter('pipeline_rule_rejected_rows',
+                                'Rows removed by each basic_preprocessing rule', ['rule'])
+
+
+def to_categorical(s, mapping):
+    """
+    Map codes to names through the distinct values only and return a
+    categorical Series whose categories are the mapping's values.
+    Codes missing from the mapping become NaN.
+    """
+    dtype = pd.CategoricalDtype(categories=list(dict.fromkeys(mapping.values())))
+    if s.dtype == dtype:
+        return s
+    codes = s.astype('category')
+    names = [mapping.get(str(c)) for c in codes.cat.categories]
+    # Trailing -1 keeps missing values (code -1) missing
+    lut = np.array([dtype.categories.get_loc(n) if n is not None else -1
+                    for n in names] + [-1], dtype=np.int64)
+    values = pd.Categorical.from_codes(lut[codes.cat.codes.to_numpy()], dtype=dtype)
+    return pd.Series(values, index=s.index, name=s.name)
+
+
+def filter_mask(df, rules=FILTER_RULES):
+    """
+    Evaluate every rule on the full table and combine them into one mask.
+    Returns the mask and a report with the number of rows each rule rejected
+    among the rows that passed the rules before it.
+    """
+    keep = np.ones(len(df), dtype=bool)
+    report = []
+    for stage, name, rule in rules:
+        passed = np.asarray(rule(df), dtype=bool)
+        rejected = np.count_nonzero(keep & ~passed)
+        keep &= passed
+        report.append({'stage': stage, 'rule': name, 'rejected': rejected})
+    return keep, pd.DataFrame(report)
+
+
+@instrument
+def basic_preprocessing(df=None, verbose=True):
+    df['payment_type'] = to_categorical(df['payment_type'], Payment_Type)
+    df['RateCodeID'] = to_categorical(df['RateCodeID'], RateCode)
+    df['VendorID'] = to_categorical(df['VendorID'], VendorID)
 
     # Add trip features
     # Add two new variables to the table
     # Duration - Length of the trip, in minutes calculated from the pickup and drop off times.
     # AveSpeed - Average speed, in mph, calculated from the distance and duration values.
-    print('Adding new features: Duration...\n')
     df['duration'] = pd.to_timedelta((df.tpep_dropoff_datetime - df.tpep_pickup_datetime),
                                      unit='minutes').dt.seconds / 60
 
-    # Only keep trips with typical values
-    # Typical trip
-    print('Only keep trips with typical values..\n')
-    df.query('duration >= 1 & duration <= 120', inplace=True)
-    df.query('trip_distance >= 0.01 & trip_distance <= 50', inplace=True)
-
-    # Typical charges
-    df.query('fare_amount >= 0.01 & fare_amount <= 100', inplace=True)
-    df.query('tolls_amount <= 20', inplace=True)
-    df.query('total_amount >= 0.5 & total_amount <= 120', inplace=True)
-
+    keep, report = filter_mask(df)
+    for row in report.itertuples():
+        RULE_REJECTED.labels(row.rule).inc(row.rejected)
+    if verbose:
+        for stage, rules in report.groupby('stage', sort=False):
+            print(stage)
+            for row in rules.itertuples():
+                print(f'    {row.rule}: {row.rejected} rows removed')
+            print()
+        print(f'Kept {keep.sum()} of {len(df)} rows\n')
+
+    df = df.take(np.flatnonzero(keep))
     df.reset_index(inplace=True, drop=True)
     return df
 
 
+@instrument
 def add_avespeed(df):
     df['ave_speed'] = (60 * df.trip_distance) / df['duration']
     df.query('ave_speed >= 0.1 & ave_speed <= 100', inplace=True)
@@ -119,6 +410,7 @@ def add_avespeed(df):
     return df
 
 
+@instrument
 def add_dayof_week(df):
     # Determine day of the week of pick up date
     # This feature is a categoical array indicating the day of the week the trip began,
@@ -128,6 +420,7 @@ def add_dayof_week(df):
     return df
 
 
+@instrument
 def add_timeof_day(df):
     # Calculate time of day of pick up
     # This feature represents pick up time as the elapsed time since midnight in decimal hours
@@ -140,19 +433,22 @@ def add_timeof_day(df):
     return df
 
 
-def add_crow_direction(df):
+@instrument
+def add_crow_direction(df, chunksize=1_000_000):
     """
     Calculate trip direction
     This feature represents the direction of travel, and is found by taking
     the angle between North and the line connecting trip pick up and drop off locations.
     CrowDirection is in units of degrees and increases clockwise from North.
+    Geod.inv is called on whole coordinate arrays, chunksize rows at a time.
     """
     g = Geod(ellps='WGS84')
-    df['crow_direction'] = df.apply(azimuthal, axis=1, args=[g])
+    df['crow_direction'] = azimuths(df, g, chunksize=chunksize)
     df.reset_index(inplace=True, drop=True)
     return df
 
 
+@instrument
 def add_crow_distance(df):
     """
     This feature is the straight line distance in miles between trip pick up and drop off locations.
@@ -171,72 +467,194 @@ def azimuthal(x, g):
     return az
 
 
+def azimuths(df, g, chunksize=1_000_000):
+    # Vectorized version of azimuthal, bounded to chunksize rows per Geod.inv call
+    cols = ['pickup_longitude', 'pickup_latitude',
+            'dropoff_longitude', 'dropoff_latitude']
+    coords = [df[col].to_numpy(dtype=float) for col in cols]
+    az = np.empty(len(df), dtype=float)
+    for start in range(0, len(df), chunksize):
+        stop = start + chunksize
+        az[start:stop], _, _ = g.inv(*(c[start:stop] for c in coords))
+    return az
+
+
 def sin_azimuth(x):
     return math.sin(math.radians(x['azimuth']))
 
 
+@instrument
+def add_azimuth_components(df, col='crow_direction'):
+    # Vectorized sin/cos of a direction column in degrees (see sin_azimuth)
+    radians = np.radians(df[col].to_numpy(dtype=float))
+    df[f'sin_{col}'] = np.sin(radians)
+    df[f'cos_{col}'] = np.cos(radians)
+    return df
+
+
+# Names of the various toll sources to classify
+TOLL_SOURCES = ['NoToll', 'CBGH', 'HH', 'VN', 'MTA_Other', 'CBGH_MTA_Other',
+                'HH_MTA_Other', 'VN_MTA_Other', 'NYPA',
+                'NYPA_MTA_Other', 'OtherToll']
+# Charged amounts matching no known toll
+OTHER_TOLL = TOLL_SOURCES.index('OtherToll')
+
+# Convert multiple rates to the corresponding EZ-pass off-peak rate captured in tolls.
+TOLLS = [0, 2, 2.44, 10.66, 5.33, 7.33, 7.77, 15.99, 9.75, 15.08, 999, ]
+TOLL_CONVERSIONS = [[4, 3.75, 7.50, 2.08, 4.16, 8.00], [4.88, 5, 10, 2.54, 5.08, 5.50, 11],
+                    [15, 11.08, 16], [5.54], [7.62], [8.08], [16.62],
+                    [11.75, 10.50, 12.50], [17.08, 16.04, 18.04, 15.29, 17.29],
+                    ]
+
+
+def cents(amounts):
+    return np.round(np.asarray(amounts, dtype=float) * 100)
+
+
+def toll_lookup():
+    # Charged amount in cents -> index into TOLL_SOURCES
+    lookup = {}
+    for code, toll in enumerate(TOLLS[:-1]):
+        lookup[cents(toll)] = code
+    for code, conv in enumerate(TOLL_CONVERSIONS, 1):
+        for amount in conv:
+            lookup[cents(amount)] = code
+    return lookup
+
+
+TOLL_LOOKUP = toll_lookup()
+
+# Merge similar toll categories and rename MTA_Other and OtherToll classes
+TOLL_GROUPS = {'CBGH': 'CBGH', 'CBGH_MTA_Other': 'CBGH',
+               'HH': 'HH', 'HH_MTA_Other': 'HH',
+               'VN': 'VN', 'VN_MTA_Other': 'VN',
+               'NYPA': 'NYPA', 'NYPA_MTA_Other': 'NYPA',
+               'MTA_Other': 'MTA', 'OtherToll': 'Other', }
+
+
+@instrument
 def add_toll_source(df):
     # add toll source
     # adds the feature TollSource to taxiTable.
     # This feature is a categorical array indicating the source of the toll charges.
     # Known toll amounts for each source are compared to the charged amount to determine the source(s).
-    df['toll_source'] = df['tolls_amount']
-    # Names of the various toll sources to classify
-    sources = ['NoToll', 'CBGH', 'HH', 'VN', 'MTA_Other', 'CBGH_MTA_Other',
-               'HH_MTA_Other', 'VN_MTA_Other', 'NYPA',
-               'NYPA_MTA_Other', 'OtherToll']
-
-    # Convert multiple rates to the corresponding EZ-pass off-peak rate captured in tolls.
-    tolls = [0, 2, 2.44, 10.66, 5.33, 7.33, 7.77, 15.99, 9.75, 15.08, 999, ]
-    tollconversions = [[4, 3.75, 7.50, 2.08, 4.16, 8.00], [4.88, 5, 10, 2.54, 5.08, 5.50, 11],
-                       [15, 11.08, 16], [5.54], [7.62], [8.08], [16.62],
-                       [11.75, 10.50, 12.50], [17.08, 16.04, 18.04, 15.29, 17.29],
-                       ]
+    # Charged amounts are matched to the cent through TOLL_LOOKUP, looking up
+    # each distinct amount only once.
+    amount = cents(df['tolls_amount'])
+    known = np.isfinite(amount)
+    inverse, unique = pd.factorize(amount[known])
+    codes = np.full(len(df), OTHER_TOLL, dtype=np.int8)
+    codes[known] = np.array([TOLL_LOOKUP.get(a, OTHER_TOLL) for a in unique],
+                            dtype=np.int8)[inverse]
+
     # Use latitude to determine source of $7.50/$8 tolls
     # If pick up and drop off locations are North of CBGH, assign MTA_Other rate
-    query1 = df.toll_source.isin([7.50, 8])
+    query1 = np.isin(amount, cents([7.50, 8]))
     query2 = (df.pickup_latitude > 40.617) & (df.dropoff_latitude > 40.617)
-    df.loc[(query1 & query2), 'toll_source'] = 5.33
+    codes[query1 & query2.to_numpy()] = TOLL_SOURCES.index('MTA_Other')
 
     # Use longitude to determine source of $10.66/$15/$11.08/$16 tolls
     # If pick up and drop off locations are East of VN, assign MTA_Other rate
-    query1 = df.toll_source.isin([10.66, 15, 11.08, 16])
+    query1 = np.isin(amount, cents([10.66, 15, 11.08, 16]))
     query2 = (df.pickup_longitude > -74.05) & (df.dropoff_longitude > -74.05)
-    df.loc[(query1 & query2), 'toll_source'] = 5.33
-
-    for toll, conv in zip(tolls[1:-1], tollconversions):
-        df.loc[df.toll_source.isin(conv), 'toll_source'] = toll
+    codes[query1 & query2.to_numpy()] = TOLL_SOURCES.index('MTA_Other')
 
-    # Change all unknown toll charges to NaN.
-    df.loc[~df.toll_source.isin(tolls), 'toll_source'] = 999
-
-    # Convert TollSource to a categorical and replace the amounts with source names
-    cat = dict(zip(tolls, sources))
-    df.loc[:, 'toll_source'] = df['toll_source'].apply(lambda x: cat.get(x))
+    df['toll_source'] = pd.Categorical.from_codes(codes, categories=TOLL_SOURCES)
     df.reset_index(inplace=True, drop=True)
     return df
 
 
+@instrument
 def add_toll_paid(df):
-    df.loc[:, 'toll_paid'] = df.tolls_amount > 0
-    df.loc[df.toll_paid.isin([True]), 'toll_paid'] = "Toll"
-    df.loc[df.toll_paid.isin([False]), 'toll_paid'] = "NoToll"
+    df['toll_paid'] = pd.Categorical(np.where(df.tolls_amount > 0, "Toll", "NoToll"),
+                                     categories=["NoToll", "Toll"])
     df.reset_index(inplace=True, drop=True)
     return df
 
 
+@instrument
 def filter_toll(df):
     # Only keep trips where a toll was charged
-    df.query("toll_source != 'NoToll'", inplace=True)
-
-    # Merge similar toll categories
-    df.loc[df.toll_source.isin(["HH", "HH_MTA_Other"]), 'toll_source'] = "HH"
-    df.loc[df.toll_source.isin(["VN", "VN_MTA_Other"]), 'toll_source'] = "VN"
-    df.loc[df.toll_source.isin(["CBGH", "CBGH_MTA_Other"]), 'toll_source'] = "CBGH"
-    df.loc[df.toll_source.isin(["NYPA", "NYPA_MTA_Other"]), 'toll_source'] = "NYPA"
+    df = df.take(np.flatnonzero(df.toll_source != 'NoToll'))
 
-    # Rename MTA_Other and OtherToll classes.
-    df.loc[df.toll_source.isin(["MTA_Other"]), 'toll_source'] = "MTA"
-    df.loc[df.toll_source.isin(["OtherToll"]), 'toll_source'] = "Other"
+    # Merge similar toll categories, then rename MTA_Other and OtherToll classes.
+    df['toll_source'] = to_categorical(df['toll_source'], TOLL_GROUPS)
     df.reset_index(inplace=True, drop=True)
     return df
+
+
+def file_fingerprint(path):
+    stat = path.stat()
+    return [path.name, stat.st_size, stat.st_mtime_ns]
+
+
+def cache_key(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def params_key(**params):
+    # Changes when a preprocessing parameter, filter rule or bound changes
+    params['rules'] = [name for _, name, _ in FILTER_RULES]
+    params['bounds'] = [lat, lon]
+    return cache_key(params)
+
+
+def files_key(files):
+    # Changes whenever a source file is added, removed, resized or touched
+    return cache_key([file_fingerprint(f) for f in files])
+
+
+def read_cache(path, columns=None):
+    # Memory-mapped read of only the requested columns
+    if path.suffix == '.feather':
+        import pyarrow.feather as feather
+        table = feather.read_table(path, columns=columns, memory_map=True)
+    else:
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas()
+
+
+def write_cache(df, path):
+    if path.suffix == '.feather':
+        # Uncompressed so that reads can map the file instead of decoding it
+        df.to_feather(path, compression='uncompressed')
+    else:
+        df.to_parquet(path, index=False)
+
+
+def cached_load(cache_dir, path_dir=None, filename=None, parse_dates=None,
+                usecols=None, dtype=None, file_substr='yellow', skiprows=0,
+                features=(add_timeof_day, add_dayof_week, add_crow_direction),
+                columns=None, fmt='parquet', workers=None, compact=False):
+    """
+    load_data(preprocess=True) followed by the feature functions, backed by
+    a columnar (parquet or feather) cache in cache_dir.
+    Entries are keyed on the source file fingerprints and the preprocessing
+    parameters; on rebuild, entries for the same source and parameters built
+    from older files are removed. Entries with other parameters are kept.
+    Only the requested columns are read back from the cache.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    files = [path_dir / filename] if filename else data_files(path_dir, file_substr)
+    params = params_key(parse_dates=parse_dates, usecols=usecols, dtype=dtype,
+                        skiprows=skiprows, features=[f.__name__ for f in features],
+                        compact=compact)
+    prefix = f"{path_dir.name}-{filename or file_substr}-{params}".replace(' ', '_')
+    path = cache_dir / f"{prefix}-{files_key(files)}.{fmt}"
+    if path.exists():
+        print(f"Loading cached {path.name}...\n")
+        return read_cache(path, columns)
+
+    # Only entries with the same parameters built from older files are stale
+    for stale in cache_dir.glob(f"{prefix}-*.{fmt}"):
+        stale.unlink()
+    df = load_data(path_dir=path_dir, filename=filename, parse_dates=parse_dates,
+                   usecols=usecols, dtype=dtype, file_substr=file_substr,
+                   skiprows=skiprows, preprocess=True, workers=workers,
+                   compact=compact)
+    for add_feature in features:
+        df = add_feature(df)
+    write_cache(df, path)
+    print(f"Cached {len(df)} rows to {path}\n")
+    return df if columns is None else df[columns]
@@ -1,14 +1,13 @@
 import streamlit as st
-import pandas as pd
 import os
 from datetime import datetime
 
-from helper import calculate_distance, prepare_data
+from helper import cached_distance, cached_features, trip_points
+from metrics import Timings, serve_metrics, timer
+from model_store import ENGINE_PATH, MMAP_MODEL_PATH, MODEL_PATH, load_model
+from prediction_cache import feature_key, make_cache
 from dotenv import load_dotenv
 
-from googleapiclient import discovery
-from google.api_core.client_options import ClientOptions
-
 
 # Load environmental variables
 load_dotenv()
@@ -16,20 +15,50 @@ load_dotenv()
 PROJECT_ID = os.environ['PROJECT_ID']
 VERSION_NAME = os.environ['VERSION_NAME']
 MODEL_NAME = os.environ['MODEL_NAME']
-endpoint = 'https://ml.googleapis.com'
+
+# Imported after load_dotenv so ML_ENDPOINT/ML_TIMEOUT/ML_DEADLINE/ML_RETRIES can come from .env
+import ai_platform  # noqa: E402
+
+
+# One predictor per server process, shared by all sessions.
+# Calls go through the coalescer and fall back to the local model on timeout;
+# the local model (engine, mmap or regular artifact) is loaded here, not on
+# the first timeout.
+@st.cache(allow_output_mutation=True)
+def get_predictor():
+    name = ai_platform.model_name(PROJECT_ID, MODEL_NAME, VERSION_NAME)
+    coalescer = ai_platform.RequestCoalescer(name)
+    fallback = None
+    if any(os.path.exists(p) for p in (ENGINE_PATH, MMAP_MODEL_PATH, MODEL_PATH)):
+        fallback, _ = load_model()
+    return ai_platform.AsyncPredictor(send=coalescer.predict, fallback=fallback,
+                                      deadline=ai_platform.DEADLINE)
+
+
+@st.cache(allow_output_mutation=True)
+def load_cache():
+    return make_cache(ai_platform.model_name(PROJECT_ID, MODEL_NAME, VERSION_NAME))
+
+
+@st.cache(allow_output_mutation=True)
+def start_metrics():
+    # Prometheus metrics on $METRICS_PORT, if set
+    return serve_metrics()
+
+
+timings = Timings()
+start_metrics()
+# time_input resets whenever its default changes, so the default pickup time
+# is fixed once per session instead of taking datetime.now() on every rerun
+if 'pickup_time' not in st.session_state:
+    st.session_state.pickup_time = datetime.now().time().replace(second=0, microsecond=0)
 
 
 # Load model
 def make_prediction(data):
-    client_options = ClientOptions(api_endpoint=endpoint)
-    service = discovery.build('ml', 'v1', client_options=client_options)
-    name = f'projects/{PROJECT_ID}/models/{MODEL_NAME}/versions/{VERSION_NAME}'
     instances = data.values.tolist()
-    response = service.projects().predict(name=name,
-                                          body={'instances': instances}
-                                          ).execute()
-
-    return response
+    response, latency = get_predictor().predict_sync(instances)
+    return response, latency
 
 
 # st.title("""New York City Map""")
@@ -37,7 +66,7 @@ st.markdown("<h1 style='text-align: center; color: black;'>New York City Map</h1
 
 st.sidebar.header('Taxi Trip Details')
 dt = st.sidebar.date_input('Date')
-tmd = st.sidebar.time_input('Time Of Day', value=datetime.now().time())
+tmd = st.sidebar.time_input('Time Of Day', value=st.session_state.pickup_time)
 
 # st.sidebar.subheader('Pickup Coordinates')
 st.sidebar.write("""#### Pickup Coordinates""")
@@ -56,7 +85,9 @@ drop_long = st.sidebar.number_input('Longitude', min_value=-74.1923,
                                     max_value=-73.5982, format='%.4f')
 
 
-dist1, dist2, dist3 = calculate_distance((pick_lat, pick_long), (drop_lat, drop_long))
+pickup, dropoff = (pick_lat, pick_long), (drop_lat, drop_long)
+with timings.section('distance'):
+    dist1 = cached_distance(pickup, dropoff)
 
 st.sidebar.number_input('Distance (miles)', value=dist1)
 
@@ -68,33 +99,60 @@ col1, col2 = st.sidebar.beta_columns(2)
 with col1:
     duration = st.button('Predict')
 
-prepared_data = prepare_data((pick_lat, pick_long), (drop_lat, drop_long),
-                             dist1, dt, tmd, passenger, )
+with timings.section('features'), timer('prepare'):
+    prepared_data = cached_features(pickup, dropoff, dist1, dt, tmd, passenger)
+    key = feature_key(prepared_data.iloc[0])
 with col2:
     if duration:
-        response = make_prediction(prepared_data)
-        if 'error' in response:
-            st.write(response)
+        cache = load_cache()
+        cached = cache.lookup(prepared_data)[0]
+        if cached is not None:
+            st.session_state.prediction = {'key': key, 'minutes': cached,
+                                           'note': "cached prediction"}
+        else:
+            with timings.section('predict'):
+                response, latency = make_prediction(prepared_data)
+            if 'error' in response:
+                st.session_state.prediction = {'key': key, 'error': response}
+            else:
+                # Local fallback answers are not the endpoint model's, keep them out of its cache
+                if latency.get('source') != 'local':
+                    cache.store(prepared_data, response['predictions'])
+                st.session_state.prediction = {'key': key,
+                                               'minutes': response['predictions'][0]}
+            if latency.get('source') == 'local':
+                note = (f"endpoint timed out, local model answered in "
+                        f"{latency['predict'] * 1000:.0f} ms")
+            else:
+                note = (f"client setup {latency['setup'] * 1000:.0f} ms, "
+                        f"predict {latency['predict'] * 1000:.0f} ms")
+            st.session_state.prediction['note'] = note
+    # The last prediction stays on the page until the next one
+    prediction = st.session_state.get('prediction')
+    if prediction:
+        if 'error' in prediction:
+            st.write(prediction['error'])
         else:
-            dur = response['predictions'][0]
-            st.write(f"{dur:.2f} +/- 4.00 minutes")
+            st.write(f"{prediction['minutes']:.2f} +/- 4.00 minutes")
+        if prediction['key'] != key:
+            st.caption("for the previous trip details, press Predict to update")
+        else:
+            st.caption(prediction['note'])
 
 
 # Plot Map
-data = pd.DataFrame({'latitude': [pick_lat, drop_lat, ],
-                     'longitude': [pick_long, drop_long, ]
-                     },
-                    index=['Pickup', 'Dropoff'],)
-
-st.map(data=data, zoom=9)
+with timings.section('map'):
+    data = trip_points(pickup, dropoff)
+    st.map(data=data, zoom=9)
 
 st.write("\n\n")
 st.markdown("<h3 style='text-align: center; color: black;'>Data supplied by user for prediction</h3>",
             unsafe_allow_html=True)
 cols1 = ['time_of_day', 'day_of_week', 'dayofmonth', 'dayofyear', ]
 cols2 = ['longitude', 'latitude', 'dist', 'trip_distance', ]
-st.table(prepared_data[cols1], )
-st.table(prepared_data[cols2], )
+with timings.section('tables'):
+    st.table(prepared_data[cols1], )
+    st.table(prepared_data[cols2], )
 
 # Select coordinates
 _, col2, _ = st.beta_columns([1, 3, 2])
@@ -104,3 +162,5 @@ with col2:
 _, col2, _ = st.beta_columns(3)
 with col2:
     st.button('Pick Coordinates')
+
+st.caption(timings.summary())
@@ -0,0 +1,266 @@
+"""
+Instrumentation shared by the data pipeline and the prediction apps.
+
+Pipeline stages (functions decorated with @instrument, or blocks run in
+`with stage(name)`) record rows in, rows out, elapsed seconds and the change
+in resident memory. The last records are kept in STAGES (stage_report()
+returns them as a DataFrame) and exported as Prometheus metrics.
+
+Prediction steps are timed with `with timer(step)`, step being 'prepare'
+(feature preparation), 'predict' (local model) or 'remote' (endpoint call).
+Each step has a latency histogram and an error counter.
+
+metrics_text() returns every metric of this process in the Prometheus text
+format; serve.py exposes it at /metrics, and serve_metrics() starts a
+separate metrics endpoint on $METRICS_PORT (for the Streamlit apps).
+
+Timings collects named sections of one Streamlit rerun for the page footer.
+
+Set METRICS=0 to turn everything off: @instrument then returns the function
+unchanged and stage/timer only read the clock. prometheus_client is
+optional; without it the records are still kept but nothing is exported.
+"""
+import functools
+import os
+import threading
+import time
+from collections import deque
+
+import pandas as pd
+
+try:
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily
+except ImportError:
+    prometheus_client = None
+
+
+ENABLED = os.environ.get('METRICS', '1') != '0'
+EXPORT = ENABLED and prometheus_client is not None
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10)
+STAGE_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+PAGE_MB = os.sysconf('SC_PAGE_SIZE') / 2**20 if hasattr(os, 'sysconf') else 0
+
+STAGES = deque(maxlen=1000)
+server_lock = threading.Lock()
+server_started = False
+
+
+class Null:
+    # Stands in for a metric when nothing is exported
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def set(self, value):
+        pass
+
+
+def counter(name, documentation, labels=()):
+    if not EXPORT:
+        return Null()
+    return prometheus_client.Counter(name, documentation, labels)
+
+
+def histogram(name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+    if not EXPORT:
+        return Null()
+    return prometheus_client.Histogram(name, documentation, labels, buckets=buckets)
+
+
+def gauge(name, documentation, labels=()):
+    if not EXPORT:
+        return Null()
+    return prometheus_client.Gauge(name, documentation, labels)
+
+
+STAGE_SECONDS = histogram('pipeline_stage_seconds', 'Duration of the pipeline stages',
+                          ['stage'], buckets=STAGE_BUCKETS)
+STAGE_ROWS_IN = counter('pipeline_stage_rows_in', 'Rows entering the pipeline stages', ['stage'])
+STAGE_ROWS_OUT = counter('pipeline_stage_rows_out', 'Rows leaving the pipeline stages', ['stage'])
+STAGE_MEMORY = gauge('pipeline_stage_memory_delta_mb',
+                     'Resident memory change during the last run of each stage', ['stage'])
+STEP_SECONDS = histogram('prediction_step_seconds',
+                         'Latency of feature preparation, local prediction and remote calls',
+                         ['step'])
+STEP_ERRORS = counter('prediction_step_errors', 'Failed prediction steps', ['step'])
+RERUN_SECONDS = histogram('app_rerun_section_seconds',
+                          'Duration of the sections of a Streamlit rerun', ['section'])
+
+
+def rss_mb():
+    # Resident set size of this process (Linux), 0 elsewhere.
+    # os.open/os.read skip the buffered text layer of open(), a few times faster.
+    try:
+        fd = os.open('/proc/self/statm', os.O_RDONLY)
+    except OSError:
+        return 0.0
+    try:
+        return int(os.read(fd, 128).split()[1]) * PAGE_MB
+    finally:
+        os.close(fd)
+
+
+class stage:
+    """
+    with stage('filter', rows_in=len(df)) as s:
+        df = ...
+        s.rows_out = len(df)
+    """
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+    def __enter__(self):
+        if ENABLED:
+            self.memory = rss_mb()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        if not ENABLED:
+            return
+        memory = rss_mb() - self.memory
+        STAGES.append({'stage': self.name, 'rows_in': self.rows_in, 'rows_out': self.rows_out,
+                       'seconds': self.seconds, 'memory_mb': memory})
+        STAGE_SECONDS.labels(self.name).observe(self.seconds)
+        STAGE_MEMORY.labels(self.name).set(memory)
+        if self.rows_in is not None:
+            STAGE_ROWS_IN.labels(self.name).inc(self.rows_in)
+        if self.rows_out is not None:
+            STAGE_ROWS_OUT.labels(self.name).inc(self.rows_out)
+
+
+def instrument(fn=None, name=None):
+    """
+    Run a function returning a DataFrame as a stage named after it: rows in
+    is the length of its first argument when that is a DataFrame, rows out
+    the length of its result.
+    """
+    if fn is None:
+        return functools.partial(instrument, name=name)
+    if not ENABLED:
+        return fn
+    name = name or fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        first = args[0] if args else None
+        rows_in = len(first) if isinstance(first, pd.DataFrame) else None
+        with stage(name, rows_in=rows_in) as s:
+            result = fn(*args, **kwargs)
+            s.rows_out = len(result)
+        return result
+    return wrapper
+
+
+class timer:
+    """
+    with timer('predict') as t:
+        ...
+    t.seconds is the elapsed time; an exception counts as an error of the step.
+    """
+
+    def __init__(self, step):
+        self.step = step
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.seconds = time.perf_counter() - self.start
+        if EXPORT:
+            STEP_SECONDS.labels(self.step).observe(self.seconds)
+            if exc_type is not None:
+                STEP_ERRORS.labels(self.step).inc()
+
+
+class Timings:
+    """
+    Durations of the named sections of one script run (a Streamlit rerun):
+
+        timings = Timings()
+        with timings.section('features'):
+            ...
+        st.caption(timings.summary())
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sections = {}
+
+    def section(self, name):
+        return Section(self, name)
+
+    def summary(self):
+        total = (time.perf_counter() - self.start) * 1000
+        parts = ', '.join(f'{name} {seconds * 1000:.1f} ms'
+                          for name, seconds in self.sections.items())
+        return f'rerun {total:.1f} ms ({parts})' if parts else f'rerun {total:.1f} ms'
+
+
+class Section:
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        self.timings.sections[self.name] = self.timings.sections.get(self.name, 0) + seconds
+        RERUN_SECONDS.labels(self.name).observe(seconds)
+
+
+def register_cache(cache):
+    # Export the hit and miss counts of a prediction_cache.PredictionCache
+    if not EXPORT:
+        return
+
+    class CacheCollector:
+        def collect(self):
+            yield CounterMetricFamily('prediction_cache_hits', 'Prediction cache hits',
+                                      value=cache.hits)
+            yield CounterMetricFamily('prediction_cache_misses', 'Prediction cache misses',
+                                      value=cache.misses)
+
+    prometheus_client.REGISTRY.register(CacheCollector())
+
+
+def stage_report():
+    return pd.DataFrame(list(STAGES), columns=['stage', 'rows_in', 'rows_out',
+                                               'seconds', 'memory_mb'])
+
+
+def metrics_text():
+    if not EXPORT:
+        return '# metrics are disabled or prometheus_client is not installed\n'
+    return prometheus_client.generate_latest().decode()
+
+
+def serve_metrics(port=None):
+    """
+    Expose metrics_text() on http://0.0.0.0:port/ (default: $METRICS_PORT)
+    from a background thread, once per process. Does nothing without a port.
+    """
+    global server_started
+    port = port or os.environ.get('METRICS_PORT')
+    if not (EXPORT and port):
+        return False
+    with server_lock:
+        if not server_started:
+            prometheus_client.start_http_server(int(port))
+            server_started = True
+    return True
@@ -0,0 +1,129 @@
+"""
+Export and load the model artifact.
+
+    python model_store.py export model.joblib model.mmap.joblib --engine model.forest
+    python model_store.py report model.joblib model.mmap.joblib model.forest
+
+export writes the pipeline uncompressed, so that joblib.load(mmap_mode='r')
+maps its numpy arrays from the file instead of decompressing and copying
+them, and the flattened forest (forest_engine.FlatForest) to the engine
+directory. load_model prefers the engine, then the uncompressed pipeline.
+report loads each artifact in a fresh interpreter and prints the load
+time, RSS and PSS (RSS with shared pages split between the processes that
+map them).
+
+Note: scikit-learn copies the tree node arrays into its own buffers when a
+forest is unpickled, so the trees themselves are not mapped. Worker processes
+share them by loading the model once before forking (gunicorn preload_app).
+The engine's arrays are .npy files and stay mapped.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import joblib
+
+from forest_engine import FlatForest
+
+
+MODEL_PATH = os.environ.get('MODEL_PATH', 'model.joblib')
+MMAP_MODEL_PATH = os.environ.get('MMAP_MODEL_PATH', 'model.mmap.joblib')
+ENGINE_PATH = os.environ.get('ENGINE_PATH', 'model.forest')
+
+
+def memory_mb():
+    # Resident and proportional set size of this process in MB (Linux)
+    usage = {}
+    for name in ('/proc/self/smaps_rollup', '/proc/self/status'):
+        if not os.path.exists(name):
+            continue
+        with open(name) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('Rss', 'Pss', 'VmRSS'):
+                    usage.setdefault(key.replace('VmRSS', 'Rss').lower(),
+                                     int(value.split()[0]) / 1024)
+    return usage
+
+
+def derived_paths(path=MODEL_PATH):
+    """
+    Memory-mappable copy and engine directory exported from the model at path:
+    MMAP_MODEL_PATH and ENGINE_PATH for MODEL_PATH, otherwise next to it
+    (m2.joblib -> m2.mmap.joblib, m2.forest).
+    """
+    if os.path.abspath(path) == os.path.abspath(MODEL_PATH):
+        return MMAP_MODEL_PATH, ENGINE_PATH
+    stem = path[:-len('.joblib')] if path.endswith('.joblib') else path
+    return f'{stem}.mmap.joblib', f'{stem}.forest'
+
+
+def export(src=MODEL_PATH, dst=MMAP_MODEL_PATH, engine=ENGINE_PATH):
+    model = joblib.load(src)
+    joblib.dump(model, dst, compress=0)
+    if engine:
+        FlatForest.from_pipeline(model).save(engine)
+    return dst
+
+
+def load_model(path=None):
+    """
+    Load the flattened engine or the memory-mappable artifact when they
+    exist, the regular one otherwise. Both the engine and the pipeline have
+    predict(DataFrame of helper.cols); the engine passes batches of
+    FlatForest.batch_rows rows or more to the pipeline when its file exists.
+    Returns the model and a dict with the load time and memory growth.
+    """
+    path = path or next((p for p in (ENGINE_PATH, MMAP_MODEL_PATH) if os.path.exists(p)),
+                        MODEL_PATH)
+    before = memory_mb()
+    start = time.perf_counter()
+    if os.path.isdir(path):
+        # Large batches go to the pipeline, loaded when the first one arrives
+        pipeline = next((p for p in (MMAP_MODEL_PATH, MODEL_PATH) if os.path.exists(p)), None)
+        model = FlatForest.load(path, mmap_mode='r', pipeline=pipeline)
+    else:
+        model = joblib.load(path, mmap_mode='r' if path.endswith('.mmap.joblib') else None)
+    after = memory_mb()
+    return model, {'path': path, 'load_seconds': time.perf_counter() - start,
+                   **{f'{k}_mb': after[k] - before.get(k, 0) for k in after}}
+
+
+def report(paths):
+    # Measure every artifact in a fresh interpreter so imports and caches do not skew it
+    code = ('import json, sys, sklearn.compose, sklearn.ensemble, sklearn.pipeline, model_store; '
+            'print(json.dumps(model_store.load_model(sys.argv[1])[1]))')
+    rows = []
+    for path in paths:
+        out = subprocess.run([sys.executable, '-c', code, path], capture_output=True,
+                             text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        rows.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    for row in rows:
+        print(f"{row['path']}: {row['load_seconds']:.2f}s, "
+              f"RSS +{row.get('rss_mb', 0):.0f} MB, PSS +{row.get('pss_mb', 0):.0f} MB")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or compare model artifacts.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    exp = sub.add_parser('export')
+    exp.add_argument('src', nargs='?', default=MODEL_PATH)
+    exp.add_argument('dst', nargs='?', default=MMAP_MODEL_PATH)
+    exp.add_argument('--engine', default=ENGINE_PATH,
+                     help='directory for the flattened forest, empty to skip')
+    rep = sub.add_parser('report')
+    rep.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+    if args.command == 'export':
+        print(f"Wrote {export(args.src, args.dst, args.engine)}")
+    else:
+        report([os.path.abspath(p) for p in args.paths])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Score trip files offline with the trained model.
+
+    python predict_batch.py trips.csv predictions.parquet --batch-size 100000 --workers 4
+
+The input (.csv or .parquet) needs the TLC columns used by helper.prepare_trips:
+pickup_latitude, pickup_longitude, dropoff_latitude, dropoff_longitude,
+trip_distance, tpep_pickup_datetime and passenger_count.
+The output has the input columns plus predicted_duration (minutes).
+"""
+import argparse
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import joblib
+import pandas as pd
+
+from helper import prepare_trips
+from import_dataset import write_chunks
+
+
+model = None
+
+
+def load_model(path):
+    # Also used as the worker initializer, so each process loads the model once
+    global model
+    model = joblib.load(path)
+    return model
+
+
+def read_batches(path, batch_size):
+    if path.suffix == '.parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, parse_dates=['tpep_pickup_datetime'],
+                               chunksize=batch_size)
+
+
+def predict_batch(batch):
+    batch = batch.copy()
+    batch['predicted_duration'] = model.predict(prepare_trips(batch))
+    return batch
+
+
+def predict_file(in_path, out_path, model_path='model.joblib',
+                 batch_size=100_000, workers=1):
+    """
+    Stream in_path through prepare_trips and model.predict batch by batch and
+    write the predictions to out_path. Returns (rows, seconds).
+    """
+    start = time.perf_counter()
+    batches = read_batches(in_path, batch_size)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=load_model,
+                                 initargs=(model_path,)) as pool:
+            scored = bounded_map(pool, predict_batch, batches, workers * 2)
+            rows = write_chunks(report(scored, start), out_path)
+    else:
+        load_model(model_path)
+        rows = write_chunks(report(map(predict_batch, batches), start), out_path)
+    return rows, time.perf_counter() - start
+
+
+def bounded_map(pool, fn, items, max_pending):
+    # Ordered pool.map that only reads ahead max_pending items
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def report(batches, start):
+    rows = 0
+    for batch in batches:
+        rows += len(batch)
+        elapsed = time.perf_counter() - start
+        print(f"{rows} rows scored, {rows / elapsed:,.0f} rows/sec")
+        yield batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict trip durations for a CSV/Parquet file.')
+    parser.add_argument('input', type=Path)
+    parser.add_argument('output', type=Path)
+    parser.add_argument('--model', default='model.joblib')
+    parser.add_argument('--batch-size', type=int, default=100_000)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    rows, elapsed = predict_file(args.input, args.output, model_path=args.model,
+                                 batch_size=args.batch_size, workers=args.workers)
+    print(f"Scored {rows} rows in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/sec)")
+
+
+if __name__ == '__main__':
+    main()
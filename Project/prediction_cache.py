@@ -0,0 +1,195 @@
+"""
+Prediction caches keyed on the model's feature vector.
+
+The apps round coordinates to 4 decimals and the model only sees the hour
+and the day, so many requests map to the same feature vector. Both caches
+store one prediction per (model version, feature tuple):
+
+- PredictionCache: in-process LRU with a time to live.
+- SharedPredictionCache: SQLite file shared by every worker process on a host.
+
+Entries from another model version are never returned, and are dropped when
+the cache is opened with (or switched to) a new version.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def feature_key(row, decimals=6):
+    # Canonical, hashable form of one feature row
+    return tuple(round(float(v), decimals) if isinstance(v, (float, np.floating))
+                 else v.item() if isinstance(v, np.generic) else v
+                 for v in row)
+
+
+def model_version(path):
+    # Version string of a model file, changes whenever the file is replaced.
+    # A flattened forest directory is versioned by its meta.json.
+    stat = os.stat(os.path.join(path, 'meta.json') if os.path.isdir(path) else path)
+    return f'{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+class PredictionCache:
+
+    def __init__(self, maxsize=10_000, ttl=3600, version=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def set_version(self, version):
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def lookup(self, data):
+        # Cached prediction (or None) for every row of a feature DataFrame
+        return [self.get(key) for key in self.keys(data)]
+
+    def store(self, data, predictions):
+        for key, value in zip(self.keys(data), predictions):
+            self.put(key, float(value))
+
+    def keys(self, data):
+        return [feature_key(row) for row in data.itertuples(index=False)]
+
+    def predict(self, data, predict_fn):
+        """
+        Predictions for every row of data, calling predict_fn once with only
+        the distinct rows that are not cached.
+        """
+        keys = self.keys(data)
+        values = [self.get(key) for key in keys]
+        missing = {}
+        for i, (key, value) in enumerate(zip(keys, values)):
+            if value is None:
+                missing.setdefault(key, i)
+        if missing:
+            fresh = predict_fn(data.iloc[list(missing.values())])
+            found = dict(zip(missing, map(float, fresh)))
+            for key, value in found.items():
+                self.put(key, value)
+            values = [found[key] if value is None else value
+                      for key, value in zip(keys, values)]
+        return np.array(values, dtype=float)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+class SharedPredictionCache(PredictionCache):
+    """
+    PredictionCache stored in a SQLite database so that every worker process
+    shares the entries. maxsize is enforced by dropping the least recently
+    used entries every `trim_every` writes.
+    """
+
+    def __init__(self, path, maxsize=100_000, ttl=3600, version=None, trim_every=1000):
+        super().__init__(maxsize=maxsize, ttl=ttl, version=None)
+        self.path = path
+        self.trim_every = trim_every
+        self.writes = 0
+        self.local = threading.local()
+        with self.connection() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS predictions '
+                       '(version TEXT, key TEXT, value REAL, expires REAL, used REAL, '
+                       'PRIMARY KEY (version, key))')
+        self.set_version(version)
+        # Opened in the gunicorn master with preload_app: close it so that no
+        # connection is inherited by the forked workers
+        self.local.db.close()
+        self.local.db = None
+
+    def connection(self):
+        # sqlite3 connections cannot be shared between threads, nor across
+        # fork(), so there is one per (process, thread)
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = self.local.db = sqlite3.connect(self.path, timeout=5)
+            self.local.pid = os.getpid()
+        return db
+
+    def set_version(self, version):
+        if version != self.version:
+            self.version = version
+            with self.connection() as db:
+                db.execute('DELETE FROM predictions WHERE version IS NOT ?', (version,))
+
+    def clear(self):
+        with self.connection() as db:
+            db.execute('DELETE FROM predictions')
+
+    def get(self, key):
+        now = time.time()
+        with self.connection() as db:
+            row = db.execute('SELECT value FROM predictions '
+                             'WHERE version IS ? AND key = ? AND expires > ?',
+                             (self.version, json.dumps(key), now)).fetchone()
+            if row is not None:
+                db.execute('UPDATE predictions SET used = ? WHERE version IS ? AND key = ?',
+                           (now, self.version, json.dumps(key)))
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        with self.connection() as db:
+            db.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)',
+                       (self.version, json.dumps(key), value, now + self.ttl, now))
+            self.writes += 1
+            if self.writes % self.trim_every == 0:
+                db.execute('DELETE FROM predictions WHERE expires <= ?', (now,))
+                db.execute('DELETE FROM predictions WHERE rowid IN (SELECT rowid FROM '
+                           'predictions ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                           (self.maxsize,))
+
+    def stats(self):
+        size = self.connection().execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'size': size}
+
+
+def make_cache(version, path=None, **kwargs):
+    """
+    SharedPredictionCache at path (default: the PREDICTION_CACHE environment
+    variable) when one is set, otherwise an in-process PredictionCache.
+    """
+    path = path or os.environ.get('PREDICTION_CACHE')
+    if path:
+        return SharedPredictionCache(path, version=version, **kwargs)
+    return PredictionCache(version=version, **kwargs)
@@ -0,0 +1,171 @@
+"""
+Update the trained model with new monthly files instead of retraining on the full history.
+
+    python retrain.py "Taxi Data" --model model.joblib --new-trees 5 --max-trees 50
+
+The manifest (--manifest, <model stem>.retrain.json next to the model by
+default) lists the yellow*.csv files the model has been trained on. Only files
+that are not in it (or changed since) are loaded, through the preprocessing
+cache. Without a manifest every file would be new, so retrain refuses to run:
+record the files of a train.py run with --mark-trained first, or pass
+--all-files to grow the model on all of them. Part of the
+new trips is held out, the rest is transformed with the model's fitted
+preparation step and used to grow --new-trees more trees (warm start). With
+--max-trees the oldest trees are dropped beyond that count, a sliding window
+over the months. The updated model replaces --model only when its RMSE on the
+held out trips is lower than the current model's; the new files are only
+added to the manifest then, so rejected months are retried with the next ones.
+"""
+import argparse
+import copy
+import json
+import os
+import time
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+import model_store
+from import_dataset import data_files, file_fingerprint
+from train import evaluate, load_trips
+
+
+def manifest_path_for(model_path):
+    # model.joblib -> model.retrain.json, so models in one folder keep separate manifests
+    return str(Path(model_path).with_suffix('.retrain.json'))
+
+
+def read_manifest(path):
+    if not os.path.exists(path):
+        return {'files': {}, 'history': []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, path):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def new_files(data_dir, manifest, file_substr='yellow'):
+    # Files that are not in the manifest, or were replaced since
+    return [f for f in data_files(data_dir, file_substr)
+            if manifest['files'].get(f.name) != file_fingerprint(f)]
+
+
+def grow_forest(model, X, y, new_trees=5, max_trees=None):
+    """
+    Copy of the fitted pipeline with new_trees more trees fitted on X, y.
+    The preparation step and the target transform stay as fitted; with
+    max_trees only the most recent trees are kept.
+    """
+    model = copy.deepcopy(model)
+    target = model.named_steps['model']
+    forest = target.regressor_
+    Xt = model.named_steps['preparation'].transform(X)
+    yt = target.transformer_.transform(np.asarray(y).reshape(-1, 1)).ravel()
+    forest.set_params(warm_start=True, n_estimators=len(forest.estimators_) + new_trees)
+    forest.fit(Xt, yt)
+    if max_trees and len(forest.estimators_) > max_trees:
+        forest.estimators_ = forest.estimators_[-max_trees:]
+    forest.set_params(warm_start=False, n_estimators=len(forest.estimators_))
+    return model
+
+
+def promote(model, path):
+    # Write next to the target and rename, so readers never see a partial file
+    tmp = f'{path}.tmp'
+    joblib.dump(model, tmp)
+    os.replace(tmp, path)
+    # Refresh the artifacts exported from this model, which the apps load in
+    # preference to it
+    mmap_path, engine_path = model_store.derived_paths(path)
+    if os.path.exists(mmap_path) or os.path.exists(engine_path):
+        model_store.export(path, mmap_path, engine_path)
+
+
+def retrain(data_dir, model_path='model.joblib', manifest_path=None, cache_dir=None,
+            new_trees=5, max_trees=None, holdout=0.2, file_substr='yellow', all_files=False):
+    """
+    Grow the model on the new files in data_dir and promote it if it beats
+    the current one on their held out trips. Returns the history entry.
+    Without a manifest all files are new: that needs all_files=True.
+    """
+    manifest_path = manifest_path or manifest_path_for(model_path)
+    if not os.path.exists(manifest_path) and not all_files:
+        raise ValueError(f"No manifest {manifest_path}: record the files {model_path} was "
+                         f"trained on with --mark-trained, or use --all-files")
+    manifest = read_manifest(manifest_path)
+    files = new_files(data_dir, manifest, file_substr)
+    if not files:
+        print("No new files\n")
+        return None
+
+    start = time.perf_counter()
+    frames = [load_trips(data_dir, filename=f.name, cache_dir=cache_dir) for f in files]
+    X = pd.concat([X for X, _ in frames], ignore_index=True)
+    y = np.concatenate([y for _, y in frames])
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=holdout,
+                                                        random_state=42)
+    print(f"{len(files)} new files: training on {len(X_train)} trips, "
+          f"testing on {len(X_test)}\n")
+
+    current = joblib.load(model_path)
+    candidate = grow_forest(current, X_train, y_train, new_trees, max_trees)
+    before = evaluate(current, X_test, y_test)
+    after = evaluate(candidate, X_test, y_test)
+    promoted = after['rmse'] < before['rmse']
+    entry = {'time': pd.Timestamp.now().isoformat(timespec='seconds'),
+             'files': [f.name for f in files], 'rows': len(X_train),
+             'trees': len(candidate.named_steps['model'].regressor_.estimators_),
+             'current': before, 'candidate': after, 'promoted': promoted,
+             'seconds': round(time.perf_counter() - start, 1)}
+    print(f"Current RMSE {before['rmse']:.3f}, updated RMSE {after['rmse']:.3f}")
+
+    if promoted:
+        promote(candidate, model_path)
+        manifest['files'].update({f.name: file_fingerprint(f) for f in files})
+        print(f"Promoted {model_path} ({entry['trees']} trees)\n")
+    else:
+        print(f"Kept {model_path}\n")
+    manifest['history'].append(entry)
+    write_manifest(manifest, manifest_path)
+    return entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Update the model with new monthly files.')
+    parser.add_argument('data_dir', type=Path, help='folder with the yellow*.csv files')
+    parser.add_argument('--model', default=model_store.MODEL_PATH)
+    parser.add_argument('--manifest', help='default: <model stem>.retrain.json next to the model')
+    parser.add_argument('--cache-dir', type=Path, default=Path('trip_cache'),
+                        help='preprocessed data cache (import_dataset.cached_load)')
+    parser.add_argument('--new-trees', type=int, default=5)
+    parser.add_argument('--max-trees', type=int, help='keep only the most recent trees')
+    parser.add_argument('--holdout', type=float, default=0.2)
+    parser.add_argument('--mark-trained', action='store_true',
+                        help='record the files in data_dir as trained on, without training')
+    parser.add_argument('--all-files', action='store_true',
+                        help='without a manifest, train on every file in data_dir')
+    args = parser.parse_args()
+
+    if args.mark_trained:
+        # For a model trained from scratch with train.py on these files
+        manifest_path = args.manifest or manifest_path_for(args.model)
+        manifest = read_manifest(manifest_path)
+        manifest['files'].update({f.name: file_fingerprint(f) for f in data_files(args.data_dir)})
+        write_manifest(manifest, manifest_path)
+        print(f"Recorded {len(manifest['files'])} files in {manifest_path}")
+        return
+    retrain(args.data_dir, model_path=args.model, manifest_path=args.manifest,
+            cache_dir=args.cache_dir, new_trees=args.new_trees, max_trees=args.max_trees,
+            holdout=args.holdout, all_files=args.all_files)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Train on a stratified sample of the full TLC history without loading it into memory.
+
+    python sampling.py "TLC Data" --per-stratum 50 --holdout 0.01 --out model.joblib
+
+The yellow*.csv files are streamed in chunks (import_dataset.iter_data). A
+fixed fraction of every chunk (--holdout) is set aside for evaluation, and
+the other trips feed a stratified reservoir: for every (month, pickup hour,
+pickup borough) at most --per-stratum trips are kept, a uniform sample of
+all the trips seen in that stratum. Memory is bounded by the reservoir plus
+one chunk, however many files there are.
+The model is fitted on the sample, then the files are streamed a second
+time to score it on the held out trips. Held out rows are chosen from a
+seed and the chunk number, so both passes agree on them.
+"""
+import argparse
+import time
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from helper import prepare_trips
+from import_dataset import iter_data
+from train import DTYPE, PARSE_DATES, USECOLS, make_estimator
+from zones import ZoneIndex
+
+
+# First match wins, so the boxes may overlap
+BOROUGHS = [
+    # name, lat min, lat max, lon min, lon max
+    ('Manhattan', 40.700, 40.882, -74.020, -73.907),
+    ('Bronx', 40.785, 40.917, -73.933, -73.765),
+    ('Staten Island', 40.496, 40.651, -74.256, -74.052),
+    ('Brooklyn', 40.570, 40.739, -74.042, -73.855),
+    ('Queens', 40.541, 40.801, -73.962, -73.700),
+]
+OTHER = len(BOROUGHS)
+BOROUGH_INDEX = ZoneIndex.from_boxes(BOROUGHS)
+TRIP_COLUMNS = ['pickup_latitude', 'pickup_longitude', 'dropoff_latitude',
+                'dropoff_longitude', 'trip_distance', 'tpep_pickup_datetime',
+                'passenger_count', 'duration']
+
+
+def borough(lat, lon):
+    # Index into BOROUGHS of the first box containing each point, OTHER if none
+    codes = BOROUGH_INDEX.assign(lat, lon)
+    return np.where(codes < 0, OTHER, codes)
+
+
+def strata(df):
+    # One integer per (month, hour, borough)
+    pickup = df['tpep_pickup_datetime'].dt
+    month = pickup.year.to_numpy() * 12 + pickup.month.to_numpy()
+    hour = pickup.hour.to_numpy()
+    area = borough(df['pickup_latitude'].to_numpy(), df['pickup_longitude'].to_numpy())
+    return (month * 24 + hour) * (OTHER + 1) + area
+
+
+def stream_trips(data_dir, chunksize=1_000_000, max_memory=None, compact=False,
+                 file_substr='yellow'):
+    # Preprocessed chunks restricted to the training durations and columns
+    for chunk in iter_data(path_dir=data_dir, parse_dates=PARSE_DATES, usecols=USECOLS,
+                           dtype=DTYPE, file_substr=file_substr, skiprows=1,
+                           chunksize=chunksize, max_memory=max_memory, compact=compact):
+        chunk = chunk[(chunk['duration'] > 1) & (chunk['duration'] <= 65)]
+        yield chunk[TRIP_COLUMNS].reset_index(drop=True)
+
+
+def holdout_mask(n, chunk_no, holdout, seed=42):
+    return np.random.default_rng([seed, chunk_no]).random(n) < holdout
+
+
+class StratifiedReservoir:
+    """
+    Uniform sample of at most per_stratum rows per stratum over a stream of
+    chunks. Every row gets a random priority and each stratum keeps the rows
+    with the smallest ones (bottom-k sampling), which can be updated one
+    chunk at a time.
+    """
+
+    def __init__(self, per_stratum=50, seed=42):
+        self.per_stratum = per_stratum
+        self.rng = np.random.default_rng(seed)
+        self.kept = None
+        self.seen = pd.Series(dtype='int64')
+
+    def add(self, chunk):
+        chunk = chunk.assign(_stratum=strata(chunk), _priority=self.rng.random(len(chunk)))
+        self.seen = self.seen.add(chunk['_stratum'].value_counts(), fill_value=0).astype('int64')
+        rows = chunk if self.kept is None else pd.concat([self.kept, chunk], ignore_index=True)
+        rows = rows.sort_values(['_stratum', '_priority'], kind='stable')
+        rank = rows.groupby('_stratum', sort=False).cumcount().to_numpy()
+        self.kept = rows[rank < self.per_stratum].reset_index(drop=True)
+
+    def sample(self):
+        return self.kept.drop(columns=['_stratum', '_priority'])
+
+    def weights(self):
+        # Trips seen per kept trip, to reweight the sample to the full history
+        kept = self.kept['_stratum'].value_counts()
+        return (self.seen[self.kept['_stratum']] / kept[self.kept['_stratum']]).to_numpy()
+
+
+def draw_sample(data_dir, per_stratum=50, holdout=0.01, seed=42, **stream_kwargs):
+    reservoir = StratifiedReservoir(per_stratum, seed)
+    start = time.perf_counter()
+    rows = 0
+    for chunk_no, chunk in enumerate(stream_trips(data_dir, **stream_kwargs)):
+        reservoir.add(chunk[~holdout_mask(len(chunk), chunk_no, holdout, seed)])
+        rows += len(chunk)
+        print(f"Chunk {chunk_no}: {rows} trips streamed, {len(reservoir.kept)} sampled "
+              f"from {len(reservoir.seen)} strata")
+    print(f"Sampled in {time.perf_counter() - start:.1f}s\n")
+    return reservoir
+
+
+def evaluate_stream(model, data_dir, holdout=0.01, seed=42, **stream_kwargs):
+    """
+    R2, RMSE and MAE of model on the held out trips, accumulated chunk by chunk.
+    """
+    n = sum_y = sum_y2 = sse = sae = 0.0
+    for chunk_no, chunk in enumerate(stream_trips(data_dir, **stream_kwargs)):
+        chunk = chunk[holdout_mask(len(chunk), chunk_no, holdout, seed)]
+        if chunk.empty:
+            continue
+        y = chunk['duration'].to_numpy(dtype=float)
+        error = model.predict(prepare_trips(chunk)) - y
+        n += len(y)
+        sum_y += y.sum()
+        sum_y2 += (y ** 2).sum()
+        sse += (error ** 2).sum()
+        sae += np.abs(error).sum()
+    if not n:
+        return {'rows': 0}
+    return {'rows': int(n), 'r2': float(1 - sse / (sum_y2 - sum_y ** 2 / n)),
+            'rmse': float(np.sqrt(sse / n)), 'mae': float(sae / n)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train on a stratified sample of all the trips.')
+    parser.add_argument('data_dir', type=Path, help='folder with the yellow*.csv files')
+    parser.add_argument('--out', default='model.joblib')
+    parser.add_argument('--per-stratum', type=int, default=50,
+                        help='trips kept per (month, hour, borough)')
+    parser.add_argument('--holdout', type=float, default=0.01,
+                        help='fraction of the trips used for evaluation only')
+    parser.add_argument('--chunksize', type=int, default=1_000_000)
+    parser.add_argument('--max-memory', type=float, help='MB per chunk, overrides --chunksize')
+    parser.add_argument('--compact', action='store_true', help='read with compact dtypes')
+    parser.add_argument('--max-depth', type=int, default=15)
+    parser.add_argument('--n-estimators', type=int, default=15)
+    parser.add_argument('--weighted', action='store_true',
+                        help='weight the sampled trips by the size of their stratum')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    stream_kwargs = dict(chunksize=args.chunksize, compact=args.compact,
+                         max_memory=args.max_memory and args.max_memory * 2**20)
+    reservoir = draw_sample(args.data_dir, args.per_stratum, args.holdout, args.seed,
+                            **stream_kwargs)
+    sample = reservoir.sample()
+
+    model = make_estimator(n_jobs=-1)
+    model.set_params(model__regressor__max_depth=args.max_depth,
+                     model__regressor__n_estimators=args.n_estimators)
+    fit_params = {'model__sample_weight': reservoir.weights()} if args.weighted else {}
+    start = time.perf_counter()
+    model.fit(prepare_trips(sample), sample['duration'].to_numpy(), **fit_params)
+    print(f"Fitted on {len(sample)} trips in {time.perf_counter() - start:.1f}s\n")
+
+    print(f"Held out: {evaluate_stream(model, args.data_dir, args.holdout, args.seed, **stream_kwargs)}")
+    model.named_steps['model'].regressor_.set_params(n_jobs=None)
+    joblib.dump(model, args.out)
+    print(f"Wrote {args.out}")
+
+
+if __name__ == '__main__':
+    main()
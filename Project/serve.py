@@ -0,0 +1,132 @@
+"""
+HTTP/JSON prediction service around model.joblib.
+
+    gunicorn -c gunicorn.conf.py serve:app
+
+POST /predict  one trip record, a list of records or {"instances": [...]}.
+               A record is either a dict with the TLC trip fields
+               (pickup_latitude, pickup_longitude, dropoff_latitude,
+               dropoff_longitude, tpep_pickup_datetime, passenger_count and
+               optionally trip_distance, which defaults to the geodesic
+               distance) or a prepared feature row in `helper.cols` order;
+               all records of a request must be of the same kind.
+               Returns {"predictions": [minutes, ...]}.
+GET  /health   {"status": "ok"} once the model is loaded.
+GET  /metrics  request, row, error, cache and latency metrics (metrics.py) of the
+               worker process that answers, in Prometheus text format.
+"""
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from geodistance import geodesic_miles
+from helper import cols, dtype, prepare_trips
+from metrics import counter, histogram, metrics_text, register_cache, timer
+from model_store import load_model
+from prediction_cache import make_cache, model_version
+
+
+# Loaded at import: once in the gunicorn master with preload_app, and shared
+# with the forked workers
+model, load_info = load_model()
+print(f"Loaded {load_info['path']} in {load_info['load_seconds']:.2f}s")
+# In-process, or shared by all workers when PREDICTION_CACHE points to a SQLite file
+cache = make_cache(model_version(load_info['path']))
+register_cache(cache)
+
+REQUESTS = counter('predict_requests', 'Prediction requests')
+# kind: 'input' for requests answered 400, 'server' for 500
+ERRORS = counter('predict_errors', 'Failed prediction requests', ['kind'])
+ROWS = counter('predict_rows', 'Predicted rows')
+LATENCY = histogram('predict_latency_seconds', 'Prediction request latency')
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def prepare_records(records):
+    # Feature rows pass through; trip records go through prepare_trips
+    if all(isinstance(r, (list, tuple)) for r in records):
+        return pd.DataFrame(records, columns=cols).astype(dtype)
+    trips = pd.DataFrame(records)
+    trips['tpep_pickup_datetime'] = pd.to_datetime(trips['tpep_pickup_datetime'])
+    if 'trip_distance' not in trips:
+        trips['trip_distance'] = np.nan
+    missing = trips['trip_distance'].isna()
+    if missing.any():
+        trips.loc[missing, 'trip_distance'] = geodesic_miles(
+            trips.loc[missing, 'pickup_latitude'], trips.loc[missing, 'pickup_longitude'],
+            trips.loc[missing, 'dropoff_latitude'], trips.loc[missing, 'dropoff_longitude'])
+    return prepare_trips(trips)
+
+
+def predict(body):
+    with timer('prepare'):
+        try:
+            records = body.get('instances', [body]) if isinstance(body, dict) else body
+            data = prepare_records(records)
+        except Exception as exc:
+            raise BadRequest(f'{type(exc).__name__}: {exc}') from exc
+    with timer('predict'):
+        predictions = cache.predict(data, model.predict)
+    return {'predictions': predictions.tolist()}, len(data)
+
+
+def record(elapsed, rows, error=None):
+    REQUESTS.inc()
+    if error:
+        ERRORS.labels(error).inc()
+    ROWS.inc(rows)
+    LATENCY.observe(elapsed)
+
+
+def respond(start_response, status, payload, content_type='application/json'):
+    body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+    start_response(status, [('Content-Type', content_type),
+                            ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def read_body(environ):
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        return json.loads(environ['wsgi.input'].read(length))
+    except ValueError as exc:
+        # Bad Content-Length, invalid JSON or UTF-8 (JSONDecodeError, UnicodeDecodeError)
+        raise BadRequest(f'{type(exc).__name__}: {exc}') from exc
+
+
+def app(environ, start_response):
+    path = environ.get('PATH_INFO', '')
+    method = environ.get('REQUEST_METHOD', 'GET')
+    if path == '/health':
+        return respond(start_response, '200 OK', {'status': 'ok'})
+    if path == '/metrics':
+        return respond(start_response, '200 OK', metrics_text(),
+                       content_type='text/plain; version=0.0.4')
+    if path != '/predict' or method != 'POST':
+        return respond(start_response, '404 Not Found', {'error': f'{method} {path}'})
+
+    start = time.perf_counter()
+    try:
+        result, rows = predict(read_body(environ))
+    except BadRequest as exc:
+        # Unreadable JSON or records prepare_records rejects
+        record(time.perf_counter() - start, 0, 'input')
+        return respond(start_response, '400 Bad Request', {'error': str(exc)})
+    except Exception as exc:
+        # The model or the cache failed: not the caller's fault
+        record(time.perf_counter() - start, 0, 'server')
+        return respond(start_response, '500 Internal Server Error',
+                       {'error': f'{type(exc).__name__}: {exc}'})
+    record(time.perf_counter() - start, rows)
+    return respond(start_response, '200 OK', result)
+
+
+if __name__ == '__main__':
+    from wsgiref.simple_server import make_server
+    print("Serving predictions on http://127.0.0.1:8080")
+    make_server('127.0.0.1', 8080, app).serve_forever()
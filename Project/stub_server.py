@@ -0,0 +1,80 @@
+"""
+Local stand-in for the ml.googleapis.com predict endpoint.
+
+    python stub_server.py --port 8085 --model model.joblib
+    ML_ENDPOINT=http://localhost:8085 streamlit run main.py
+
+Answers POST /v1/projects/*/models/*/versions/*:predict with the predictions
+of the local model (or a constant when no model is given) and counts calls.
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import joblib
+import pandas as pd
+
+from helper import cols, dtype
+
+
+class PredictHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    model = None
+    calls = 0
+    instances = 0
+
+    def do_POST(self):
+        if not urlsplit(self.path).path.endswith(':predict'):
+            return self.reply(404, {'error': f'Unknown path {self.path}'})
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        instances = body['instances']
+        PredictHandler.calls += 1
+        PredictHandler.instances += len(instances)
+        if self.model is None:
+            predictions = [10.0] * len(instances)
+        else:
+            try:
+                data = pd.DataFrame(instances, columns=cols).astype(dtype)
+                predictions = self.model.predict(data).tolist()
+            except Exception as exc:
+                return self.reply(200, {'error': f'Prediction failed: {exc}'})
+        self.reply(200, {'predictions': predictions})
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(port=0, model_path=None):
+    """
+    Serve in a background thread. Returns the server; its endpoint is
+    f'http://127.0.0.1:{server.server_port}'.
+    """
+    PredictHandler.model = joblib.load(model_path) if model_path else None
+    server = ThreadingHTTPServer(('127.0.0.1', port), PredictHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub AI Platform predict endpoint.')
+    parser.add_argument('--port', type=int, default=8085)
+    parser.add_argument('--model', default=None)
+    args = parser.parse_args()
+    PredictHandler.model = joblib.load(args.model) if args.model else None
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), PredictHandler)
+    print(f"Serving predictions on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+Train the trip duration model (the Build_Model.ipynb pipeline) from the command line.
+
+    python train.py "Taxi Data" --out model.joblib --search halving --n-jobs -1
+
+Every candidate x fold fit runs in its own process (n_jobs), with one
+single-threaded forest each. The pipeline caches its fitted preparation step
+in a joblib Memory directory, so the ColumnTransformer is fitted once per
+fold instead of once per candidate and fold. --search halving runs
+successive halving: all candidates are fitted on a small sample and only the
+best third moves on to three times more rows at every round.
+The fit and score time of every candidate, summed over its folds, is
+printed (and written with --times); with parallel folds the search takes
+less wall time than these add up to.
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+import scipy as sp
+import scipy.special
+from sklearn.compose import ColumnTransformer, TransformedTargetRegressor
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.metrics import mean_squared_error, r2_score
+from sklearn.model_selection import (GridSearchCV, HalvingGridSearchCV, KFold,
+                                     train_test_split)
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OrdinalEncoder, StandardScaler
+
+from helper import cols, prepare_trips
+from import_dataset import (add_dayof_week, add_timeof_day, cached_load,
+                            load_data)
+
+
+USECOLS = ['VendorID', 'tpep_pickup_datetime', 'tpep_dropoff_datetime',
+           'passenger_count', 'trip_distance', 'pickup_longitude',
+           'pickup_latitude', 'RateCodeID', 'store_and_fwd_flag',
+           'dropoff_longitude', 'dropoff_latitude', 'payment_type',
+           'fare_amount', 'extra', 'mta_tax', 'tip_amount', 'tolls_amount',
+           'improvement_surcharge', 'total_amount']
+PARSE_DATES = ['tpep_pickup_datetime', 'tpep_dropoff_datetime']
+DTYPE = {'RateCodeID': str, 'payment_type': str, 'VendorID': str, 'RatecodeID': str}
+PARAMS = {
+    'model__regressor__max_depth': [15, 20],
+    'model__regressor__n_estimators': [10, 15],
+}
+
+
+def load_trips(data_dir, filename=None, cache_dir=None, workers=None, sample=None, seed=42):
+    """
+    Features (helper.cols) and duration of the preprocessed trips in data_dir
+    (or only in data_dir / filename), keeping durations in (1, 65] minutes as
+    the notebook does.
+    """
+    kwargs = dict(path_dir=data_dir, filename=filename, parse_dates=PARSE_DATES,
+                  usecols=USECOLS, dtype=DTYPE, file_substr='yellow', skiprows=1,
+                  workers=workers)
+    if cache_dir:
+        df = cached_load(cache_dir, features=(add_timeof_day, add_dayof_week), **kwargs)
+    else:
+        df = load_data(preprocess=True, **kwargs)
+    df = df[(df['duration'] > 1) & (df['duration'] <= 65)]
+    if sample:
+        df = df.sample(frac=sample, random_state=seed)
+    return prepare_trips(df), df['duration'].to_numpy()
+
+
+def make_estimator(memory=None, n_jobs=None):
+    num_ix = [i for i, c in enumerate(cols) if c != 'day_of_week']
+    cat_ix = [cols.index('day_of_week')]
+    transformer = ColumnTransformer([
+        ("num_pipe", Pipeline([("num", StandardScaler())]), num_ix),
+        ("cat_pipe", Pipeline([("cat", OrdinalEncoder())]), cat_ix),
+    ])
+    rfr = RandomForestRegressor(random_state=42, n_jobs=n_jobs)
+    model = TransformedTargetRegressor(regressor=rfr, func=np.log10,
+                                       inverse_func=sp.special.exp10)
+    return Pipeline([('preparation', transformer), ('model', model)], memory=memory)
+
+
+def search(X, y, params=PARAMS, method='grid', cv=5, n_jobs=-1, memory=None,
+           factor=3, verbose=1):
+    """
+    Fit a GridSearchCV (method='grid') or HalvingGridSearchCV ('halving')
+    over params and refit the best candidate on all of X.
+    With n_jobs != 1 the fits run in parallel and each forest is single
+    threaded, so the processes do not compete for the cores.
+    """
+    estimator = make_estimator(memory=memory, n_jobs=1 if n_jobs != 1 else -1)
+    kf = KFold(shuffle=True, random_state=42, n_splits=cv)
+    kwargs = dict(cv=kf, n_jobs=n_jobs, scoring='neg_mean_squared_error',
+                  return_train_score=True, verbose=verbose)
+    if method == 'halving':
+        grid = HalvingGridSearchCV(estimator, params, factor=factor, random_state=42, **kwargs)
+    else:
+        grid = GridSearchCV(estimator, params, **kwargs)
+    start = time.perf_counter()
+    grid.fit(X, y)
+    grid.search_seconds_ = time.perf_counter() - start
+    return grid
+
+
+def candidate_times(grid):
+    """
+    One row per fitted candidate (per round with halving): its parameters,
+    score and the fit + score time summed over the folds.
+    """
+    results = pd.DataFrame(grid.cv_results_)
+    n_splits = grid.n_splits_
+    times = pd.DataFrame({'params': results['params'].map(str),
+                          'rmse': np.sqrt(-results['mean_test_score']),
+                          'fit_seconds': results['mean_fit_time'] * n_splits,
+                          'score_seconds': results['mean_score_time'] * n_splits})
+    # Compute time over all folds, not elapsed time: folds run in parallel
+    times['fold_seconds_total'] = times['fit_seconds'] + times['score_seconds']
+    for extra in ('iter', 'n_resources'):
+        if extra in results:
+            times[extra] = results[extra]
+    return times
+
+
+def evaluate(model, X, y):
+    pred = model.predict(X)
+    return {'r2': r2_score(y, pred), 'rmse': float(np.sqrt(mean_squared_error(y, pred)))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the trip duration model.')
+    parser.add_argument('data_dir', type=Path, help='folder with the yellow*.csv files')
+    parser.add_argument('--out', default='model.joblib')
+    parser.add_argument('--search', choices=['grid', 'halving'], default='grid')
+    parser.add_argument('--max-depth', type=int, nargs='+', default=PARAMS['model__regressor__max_depth'])
+    parser.add_argument('--n-estimators', type=int, nargs='+',
+                        default=PARAMS['model__regressor__n_estimators'])
+    parser.add_argument('--cv', type=int, default=5)
+    parser.add_argument('--n-jobs', type=int, default=-1)
+    parser.add_argument('--test-size', type=float, default=0.2)
+    parser.add_argument('--sample', type=float, help='fraction of the trips to train on')
+    parser.add_argument('--cache-dir', type=Path, help='preprocessed data cache (import_dataset.cached_load)')
+    parser.add_argument('--memory', help='pipeline cache directory (default: a temporary one)')
+    parser.add_argument('--workers', type=int, help='processes reading the csv files')
+    parser.add_argument('--times', help='write the per candidate timings to this csv')
+    args = parser.parse_args()
+
+    X, y = load_trips(args.data_dir, cache_dir=args.cache_dir, workers=args.workers,
+                      sample=args.sample)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=args.test_size,
+                                                        random_state=42)
+    print(f"Training on {len(X_train)} trips, testing on {len(X_test)}\n")
+
+    memory = args.memory or tempfile.mkdtemp(prefix='train-cache-')
+    try:
+        params = {'model__regressor__max_depth': args.max_depth,
+                  'model__regressor__n_estimators': args.n_estimators}
+        grid = search(X_train, y_train, params=params, method=args.search, cv=args.cv,
+                      n_jobs=args.n_jobs, memory=memory)
+    finally:
+        if not args.memory:
+            shutil.rmtree(memory, ignore_errors=True)
+
+    times = candidate_times(grid)
+    print(times.to_string(index=False))
+    if args.times:
+        times.to_csv(args.times, index=False)
+    print(f"\nSearch took {grid.search_seconds_:.1f}s, best: {grid.best_params_}")
+    print(f"Test: {evaluate(grid.best_estimator_, X_test, y_test)}")
+
+    # The cache directory may be gone, and the served model does not need it
+    model = grid.best_estimator_.set_params(memory=None)
+    model.named_steps['model'].regressor_.set_params(n_jobs=None)
+    joblib.dump(model, args.out)
+    print(f"Wrote {args.out}")
+
+
+if __name__ == '__main__':
+    main()
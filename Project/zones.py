@@ -0,0 +1,139 @@
+"""
+Assign trips to named zones (latitude/longitude boxes) such as Manhattan or LaGuardia.
+
+    index = ZoneIndex.from_csv('../Notebooks/pickupLocations.csv')
+    codes = index.assign(df['pickup_latitude'], df['pickup_longitude'])
+
+The zones' bounding box is cut into a uniform grid and every cell lists the
+zones that touch it, in priority order. A point is only tested against the
+zones of its cell, so the cost grows with the number of zones overlapping a
+cell rather than with the number of zones. Where zones overlap the first one
+in the file wins (list airports before the boroughs around them). Boxes
+include their edges; points in no zone get -1.
+"""
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from metrics import instrument
+
+
+ZONES_PATH = os.environ.get('ZONES_PATH',
+                            str(Path(__file__).parent.parent / 'Notebooks' / 'pickupLocations.csv'))
+MAX_CELLS = 2048
+
+
+class ZoneIndex:
+
+    def __init__(self, names, lat1, lat2, lon1, lon2, cell=None):
+        self.names = list(names)
+        self.lat1, self.lat2, self.lon1, self.lon2 = (
+            np.asarray(a, dtype=float) for a in (lat1, lat2, lon1, lon2))
+        if len(self.names) != len(set(self.names)):
+            raise ValueError('zone names must be unique')
+        if np.any(self.lat1 > self.lat2) or np.any(self.lon1 > self.lon2):
+            raise ValueError('zones need Lat1 <= Lat2 and Lon1 <= Lon2')
+        self.origin = (self.lat1.min(), self.lon1.min())
+        extent = max(self.lat2.max() - self.origin[0], self.lon2.max() - self.origin[1])
+        if cell is None:
+            # About the size of the smallest zone, so most cells hold one zone
+            cell = np.minimum(self.lat2 - self.lat1, self.lon2 - self.lon1).min()
+        self.cell = max(cell, extent / MAX_CELLS, 1e-9)
+        self.shape = (int((self.lat2.max() - self.origin[0]) // self.cell) + 1,
+                      int((self.lon2.max() - self.origin[1]) // self.cell) + 1)
+        self.build()
+
+    @classmethod
+    def from_frame(cls, zones, cell=None):
+        return cls(zones['Names'], zones['Lat1'], zones['Lat2'], zones['Lon1'], zones['Lon2'],
+                   cell=cell)
+
+    @classmethod
+    def from_csv(cls, path=ZONES_PATH, cell=None):
+        return cls.from_frame(pd.read_csv(path), cell=cell)
+
+    @classmethod
+    def from_boxes(cls, boxes, cell=None):
+        # [(name, lat min, lat max, lon min, lon max), ...] as in sampling.BOROUGHS
+        names, lat1, lat2, lon1, lon2 = zip(*boxes)
+        return cls(names, lat1, lat2, lon1, lon2, cell=cell)
+
+    def cells(self, lat, lon):
+        # Grid row and column of each point; the same formula places zones and points
+        return (((lat - self.origin[0]) // self.cell).astype(np.int64),
+                ((lon - self.origin[1]) // self.cell).astype(np.int64))
+
+    def build(self):
+        # Cell -> zones touching it, as offsets into one array (CSR), sorted by priority
+        i1, j1 = self.cells(self.lat1, self.lon1)
+        i2, j2 = self.cells(self.lat2, self.lon2)
+        cell_ids, zone_ids = [], []
+        for zone in range(len(self.names)):
+            rows, cols = np.meshgrid(np.arange(i1[zone], i2[zone] + 1),
+                                     np.arange(j1[zone], j2[zone] + 1), indexing='ij')
+            cell_ids.append((rows * self.shape[1] + cols).ravel())
+            zone_ids.append(np.full(rows.size, zone))
+        cell_ids, zone_ids = np.concatenate(cell_ids), np.concatenate(zone_ids)
+        order = np.lexsort((zone_ids, cell_ids))
+        counts = np.bincount(cell_ids, minlength=self.shape[0] * self.shape[1])
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.zones = zone_ids[order].astype(np.int32)
+        self.depth = int(counts.max())
+
+    def assign(self, lat, lon):
+        """
+        Index into self.names of the zone of every point (int32, -1 for none).
+        """
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        codes = np.full(len(lat), -1, dtype=np.int32)
+        inside = ((lat >= self.origin[0]) & (lon >= self.origin[1])
+                  & (lat <= self.lat2.max()) & (lon <= self.lon2.max()))
+        points = np.flatnonzero(inside)
+        i, j = self.cells(lat[points], lon[points])
+        cell = i * self.shape[1] + j
+        start, count = self.offsets[cell], self.offsets[cell + 1] - self.offsets[cell]
+        # Test the k-th candidate of the points still unassigned, k = 0, 1, ...
+        for k in range(self.depth):
+            todo = np.flatnonzero(count > k)
+            if not len(todo):
+                break
+            zone = self.zones[start[todo] + k]
+            p = points[todo]
+            hit = ((lat[p] >= self.lat1[zone]) & (lat[p] <= self.lat2[zone])
+                   & (lon[p] >= self.lon1[zone]) & (lon[p] <= self.lon2[zone]))
+            codes[p[hit]] = zone[hit]
+            # Assigned points drop out of the next rounds
+            count[todo[hit]] = 0
+        return codes
+
+    def labels(self, lat, lon):
+        # Zone names as a Categorical, NaN outside every zone
+        return pd.Categorical.from_codes(self.assign(lat, lon), self.names)
+
+
+@lru_cache(maxsize=None)
+def load_zones(path=ZONES_PATH):
+    return ZoneIndex.from_csv(path)
+
+
+@instrument
+def add_zones(df, index=None, chunksize=1_000_000):
+    """
+    Add pickup_zone and dropoff_zone (categoricals of the zone names, NaN
+    outside every zone), assigning chunksize rows at a time.
+    Without index the zones in ZONES_PATH are used.
+    """
+    index = index or load_zones()
+    for end in ('pickup', 'dropoff'):
+        lat = df[f'{end}_latitude'].to_numpy(dtype=float)
+        lon = df[f'{end}_longitude'].to_numpy(dtype=float)
+        codes = np.concatenate([index.assign(lat[start:start + chunksize],
+                                             lon[start:start + chunksize])
+                                for start in range(0, len(df), chunksize)] or [[]])
+        df[f'{end}_zone'] = pd.Categorical.from_codes(codes.astype(np.int32), index.names)
+    return df
+